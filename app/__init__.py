@@ -1,16 +1,49 @@
+import os
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 
+from .cache import SGFCache, TimedCache
+from .storage import SGFStore
+from .tasks import TaskQueue
+from .thumbnail import ThumbnailPipeline
+from .fetch import SGFFetcher
+from .passwords import PasswordHasher
+from .search import SearchIndex
+
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_object('config')
-app.config.from_pyfile('config.py')
+# KIFUTALK_CONFIG names a settings file to use instead of
+# instance/config.py, e.g. for the tests
+if 'KIFUTALK_CONFIG' in os.environ:
+  app.config.from_envvar('KIFUTALK_CONFIG')
+else:
+  app.config.from_pyfile('config.py')
 
 db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
+password_hasher = PasswordHasher(
+  app.config['PASSWORD_WORKERS'],
+  app.config['BCRYPT_LOG_ROUNDS'],
+  app.config['PASSWORD_MAX_PENDING']
+)
+sgf_store = SGFStore(
+  os.path.join(app.config['SGF_FOLDER'], 'store'),
+  app.config['SGF_COMPRESS_LEVEL']
+)
+search_index = SearchIndex(db)
+sgf_cache = SGFCache(app.config['SGF_CACHE_SIZE'])
+notification_cache = TimedCache(app.config['NOTIFICATION_CACHE_TTL'])
+task_queue = TaskQueue(app)
+thumbnails = ThumbnailPipeline(app.config['THUMBNAIL_WORKERS'], app.config['THUMBNAIL_SIZE'])
+sgf_fetcher = SGFFetcher(
+  app.config['URL_WORKERS'],
+  app.config['URL_MAX_BYTES'],
+  app.config['URL_TIMEOUT'],
+  app.config['URL_CACHE_TTL']
+)
 
 from . import models
 
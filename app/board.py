@@ -0,0 +1,310 @@
+# a Go board that replays the actions of a parsed game tree (see sgf.py)
+# the board is a flat bytearray indexed by row * size + col
+# positions are identified by Zobrist hashes, the XOR of a random key for
+# every stone on the board, which are updated with each point that changes
+
+import random
+
+from .sgf import find_values_by_props
+
+EMPTY = 0
+BLACK = 1
+WHITE = 2
+
+DEFAULT_SIZE = 19
+# largest board size allowed by the SGF format
+MAX_SIZE = 52
+
+# letters used for coordinates, 'a' to 'z' then 'A' to 'Z'
+def letter_to_number(letter):
+  if 'a' <= letter <= 'z':
+    return ord(letter) - ord('a')
+  if 'A' <= letter <= 'Z':
+    return ord(letter) - ord('A') + 26
+  return -1
+
+# read the board size from the SZ property of the game's root node
+# 'SZ[19]' or 'SZ[19:19]', rectangular boards are not supported
+def board_size(root):
+  value = find_values_by_props(root, ('SZ',), header_only=True)['SZ']
+  try:
+    size = int(value.split(':')[0])
+  except ValueError:
+    return DEFAULT_SIZE
+  return size if 1 <= size <= MAX_SIZE else DEFAULT_SIZE
+
+# Zobrist keys of each board size, indexed by color * size * size + point
+# keys come from a fixed seed, so hashes stay the same across processes and
+# can be stored, and have 63 bits so hashes fit in a signed 64-bit column
+# empty points have key 0, so the empty board hashes to 0
+_zobrist = {}
+
+def zobrist_keys(size):
+  if size not in _zobrist:
+    rng = random.Random(size)
+    points = size * size
+    _zobrist[size] = [0] * points + [rng.getrandbits(63) for i in range(2 * points)]
+  return _zobrist[size]
+
+# the 8 rotations and reflections of a board, as maps of (row, col) on a
+# board whose last line is s, starting with the identity
+SYMMETRIES = (
+  lambda row, col, s: (row, col),
+  lambda row, col, s: (col, s - row),
+  lambda row, col, s: (s - row, s - col),
+  lambda row, col, s: (s - col, row),
+  lambda row, col, s: (row, s - col),
+  lambda row, col, s: (s - row, col),
+  lambda row, col, s: (col, row),
+  lambda row, col, s: (s - col, s - row)
+)
+
+# Zobrist keys of each symmetry, where the key of a point is the key of
+# the point it is mapped to, so that the hash with the keys of a symmetry
+# is the hash of the transformed position
+_symmetric_zobrist = {}
+
+def symmetric_zobrist_keys(size):
+  if size not in _symmetric_zobrist:
+    keys = zobrist_keys(size)
+    points = size * size
+    tables = []
+    for symmetry in SYMMETRIES:
+      mapped = []
+      for i in range(points):
+        row, col = symmetry(*divmod(i, size), size - 1)
+        mapped.append(row * size + col)
+      tables.append([
+        keys[color * points + mapped[i]]
+        for color in (EMPTY, BLACK, WHITE) for i in range(points)
+      ])
+    _symmetric_zobrist[size] = tables
+  return _symmetric_zobrist[size]
+
+class Board:
+  # symmetric=True also keeps the hashes of the 7 other symmetries of the
+  # position, for normalized_hash
+  def __init__(self, size=DEFAULT_SIZE, symmetric=False):
+    self.size = size
+    self.grid = bytearray(size * size)
+    self.keys = zobrist_keys(size)
+    self.tables = symmetric_zobrist_keys(size) if symmetric else [self.keys]
+    self.hashes = [0] * len(self.tables)
+    # (point, previous color) of every change, undone back to a mark
+    self.changes = []
+    # neighbors of every point, computed once per board
+    self.neighbors = []
+    for i in range(size * size):
+      row, col = divmod(i, size)
+      adjacent = []
+      if row > 0:
+        adjacent.append(i - size)
+      if row < size - 1:
+        adjacent.append(i + size)
+      if col > 0:
+        adjacent.append(i - 1)
+      if col < size - 1:
+        adjacent.append(i + 1)
+      self.neighbors.append(tuple(adjacent))
+
+  @property
+  def hash(self):
+    return self.hashes[0]
+
+  # the same for all 8 symmetries of a position, e.g. for mirrored josekis
+  @property
+  def normalized_hash(self):
+    return min(self.hashes)
+
+  # index of an SGF point such as 'pd', or -1 for passes and
+  # points that are not on the board
+  def point(self, value):
+    if len(value) != 2:
+      return -1
+    col = letter_to_number(value[0])
+    row = letter_to_number(value[1])
+    if not (0 <= row < self.size and 0 <= col < self.size):
+      return -1
+    return row * self.size + col
+
+  # indices of a point or a compressed point list such as 'aa:cc'
+  def points(self, value):
+    if ':' not in value:
+      i = self.point(value)
+      return [] if i == -1 else [i]
+    corner1, corner2 = value.split(':', 1)
+    i1 = self.point(corner1)
+    i2 = self.point(corner2)
+    if i1 == -1 or i2 == -1:
+      return []
+    row1, col1 = divmod(i1, self.size)
+    row2, col2 = divmod(i2, self.size)
+    return [
+      row * self.size + col
+      for row in range(min(row1, row2), max(row1, row2) + 1)
+      for col in range(min(col1, col2), max(col1, col2) + 1)
+    ]
+
+  # stones of the group at i, and whether the group has any liberty
+  def group(self, i):
+    grid = self.grid
+    color = grid[i]
+    stones = [i]
+    seen = {i}
+    has_liberty = False
+    k = 0
+    while k < len(stones):
+      for n in self.neighbors[stones[k]]:
+        if n in seen:
+          continue
+        if grid[n] == color:
+          seen.add(n)
+          stones.append(n)
+        elif grid[n] == EMPTY:
+          has_liberty = True
+      k += 1
+    return stones, has_liberty
+
+  # set point i to color, returning the previous color
+  # every change to the grid goes through here
+  def set(self, i, color):
+    previous = self.grid[i]
+    points = len(self.grid)
+    self.grid[i] = color
+    hashes = self.hashes
+    for k, keys in enumerate(self.tables):
+      hashes[k] ^= keys[previous * points + i] ^ keys[color * points + i]
+    self.changes.append((i, previous))
+    return previous
+
+  # position to come back to with undo
+  def mark(self):
+    return len(self.changes)
+
+  # take back every change made since mark
+  def undo(self, mark):
+    grid = self.grid
+    points = len(grid)
+    changes = self.changes
+    hashes = self.hashes
+    while len(changes) > mark:
+      i, previous = changes.pop()
+      for k, keys in enumerate(self.tables):
+        hashes[k] ^= keys[grid[i] * points + i] ^ keys[previous * points + i]
+      grid[i] = previous
+
+  # play a stone of color at i and resolve captures
+  # returns the list of captured points, or None if i is occupied
+  # a suicide removes the player's own group
+  def play(self, color, i):
+    grid = self.grid
+    if grid[i] != EMPTY:
+      return None
+    self.set(i, color)
+    captured = []
+    opponent = BLACK if color == WHITE else WHITE
+    for n in self.neighbors[i]:
+      if grid[n] == opponent:
+        stones, has_liberty = self.group(n)
+        if not has_liberty:
+          for s in stones:
+            self.set(s, EMPTY)
+          captured.extend(stones)
+    if len(captured) == 0:
+      stones, has_liberty = self.group(i)
+      if not has_liberty:
+        for s in stones:
+          self.set(s, EMPTY)
+        captured.extend(stones)
+    return captured
+
+  # execute one SGF action, ignoring properties that do not change
+  # the position
+  def execute(self, prop, value):
+    if prop == 'B' or prop == 'W':
+      i = self.point(value)
+      # passes ('' or 'tt') and illegal moves leave the board unchanged
+      if i != -1:
+        self.play(BLACK if prop == 'B' else WHITE, i)
+    elif prop == 'AB' or prop == 'AW' or prop == 'AE':
+      color = {'AB': BLACK, 'AW': WHITE, 'AE': EMPTY}[prop]
+      for i in self.points(value):
+        self.set(i, color)
+
+  def execute_node(self, node):
+    for prop, value in node.action_pairs():
+      self.execute(prop, value)
+
+# the board at the end of the main line (first child at every node)
+def main_line_position(root):
+  board = Board(board_size(root))
+  node = root
+  board.execute_node(node)
+  while len(node.children) > 0:
+    node = node.children[0]
+    board.execute_node(node)
+  return board
+
+# the board at node, replayed from the root of its game tree
+def node_position(node, symmetric=False):
+  path = []
+  while node is not None:
+    path.append(node)
+    node = node.parent
+  board = Board(board_size(path[-1]), symmetric)
+  for node in reversed(path):
+    board.execute_node(node)
+  return board
+
+# position hash of every node of the game tree at root, by node id
+# with symmetric=True, the hashes are (hash, normalized hash) pairs
+# every variation is replayed on a single board, which is taken back to
+# the branching node with undo instead of being copied for each branch
+# nodes limits the walk to the subtrees of some nodes of the tree (e.g.
+# nodes just added to it), and their paths are replayed first
+def position_hashes(root, symmetric=False, nodes=None):
+  board = Board(board_size(root), symmetric)
+  hashes = {}
+  for start in ([root] if nodes is None else nodes):
+    path = []
+    node = start.parent
+    while node is not None:
+      path.append(node)
+      node = node.parent
+    for node in reversed(path):
+      board.execute_node(node)
+
+    # (node, None) replays a node, (node, mark) takes it back
+    stack = [(start, None)]
+    while stack:
+      node, mark = stack.pop()
+      if mark is not None:
+        board.undo(mark)
+        continue
+      mark = board.mark()
+      board.execute_node(node)
+      hashes[node.id] = (board.hash, board.normalized_hash) if symmetric else board.hash
+      if node.children:
+        stack.append((node, mark))
+        stack.extend((child, None) for child in reversed(node.children))
+      else:
+        board.undo(mark)
+    board.undo(0)
+  return hashes
+
+# (node id, hash, normalized hash) of the nodes of a game tree worth
+# indexing by position, in preorder: the first node that reaches each
+# position (or one of its symmetries), leaving out the empty board
+# nodes is as in position_hashes, and seen is a pair of sets of hashes and
+# normalized hashes reached already, which is updated
+def position_entries(root, nodes=None, seen=None):
+  seen_hashes, seen_normalized = (set(), set()) if seen is None else seen
+  entries = []
+  for node_id, (h, normalized) in position_hashes(root, True, nodes).items():
+    if h == 0:
+      continue
+    if h not in seen_hashes or normalized not in seen_normalized:
+      seen_hashes.add(h)
+      seen_normalized.add(normalized)
+      entries.append((node_id, h, normalized))
+  return entries
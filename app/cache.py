@@ -0,0 +1,207 @@
+import threading, time
+from collections import OrderedDict
+
+from .sgf import SGF, index_tree, replay_patch
+from .storage import file_stamp, read_patch_log, read_sgf_file
+
+# in-process LRU cache of SGF file contents and parsed game trees
+# entries are keyed by kifu id and checked against the path, mtime and
+# size of the SGF file and its patch log, so files changed behind the
+# cache's back are never served stale
+# parsed trees are shared between requests and must not be mutated,
+# patches are applied to a copy that then takes the place of the tree
+# (see patched)
+class SGFCache:
+  # rough memory cost of a parsed tree relative to the length of its
+  # SGF string (measured on real games with variations)
+  TREE_COST_FACTOR = 30
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.__entries = OrderedDict()
+    self.__lock = threading.Lock()
+
+  def __stamp(self, path, log_path):
+    stamp = file_stamp(path)
+    if stamp is None:
+      raise FileNotFoundError(path)
+    log_stamp = None if log_path is None else file_stamp(log_path)
+    # an empty log is the same as no log
+    if log_stamp is not None and log_stamp[1] == 0:
+      log_stamp = None
+    return ((path,) + stamp, log_stamp)
+
+  def __cost(self, entry):
+    cost = entry['length']
+    if entry['tree'] is not None:
+      cost += entry['length'] * self.TREE_COST_FACTOR
+    return cost
+
+  # return the cached entry for kifu_id if it is still fresh
+  # must be called with the lock held
+  def __lookup(self, kifu_id, stamp):
+    entry = self.__entries.get(kifu_id)
+    if entry is None or entry['stamp'] != stamp:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.__entries.move_to_end(kifu_id)
+    return entry
+
+  # insert or replace an entry and evict least recently used ones
+  # must be called with the lock held
+  def __store(self, kifu_id, entry):
+    self.__discard(kifu_id)
+    entry['cost'] = self.__cost(entry)
+    # entries larger than the whole budget are not cached
+    if entry['cost'] > self.max_bytes:
+      return
+    self.__entries[kifu_id] = entry
+    self.size += entry['cost']
+    while self.size > self.max_bytes:
+      _, evicted = self.__entries.popitem(last=False)
+      self.size -= evicted['cost']
+
+  def __discard(self, kifu_id):
+    entry = self.__entries.pop(kifu_id, None)
+    if entry is not None:
+      self.size -= entry['cost']
+
+  # parse the SGF file and replay its patch log
+  # the log is read before the SGF file, see storage.locked_patch_log
+  def __load(self, kifu_id, stamp, path, log_path, sgf_str):
+    ops = [] if stamp[1] is None else read_patch_log(log_path)
+    if sgf_str is None:
+      sgf_str = read_sgf_file(path)
+    root = SGF().parse(sgf_str)
+    index = index_tree(root)
+    replay_patch(index, ops)
+    entry = {
+      'stamp': stamp,
+      # the file contents are only the whole kifu if nothing was patched
+      'sgf': sgf_str if len(ops) == 0 else None,
+      'tree': root,
+      'index': index,
+      'length': len(sgf_str) + (0 if stamp[1] is None else stamp[1][1])
+    }
+    with self.__lock:
+      self.__store(kifu_id, entry)
+    return entry
+
+  # SGF string of the kifu stored at path (and patched by log_path)
+  def get_sgf(self, kifu_id, path, log_path=None):
+    stamp = self.__stamp(path, log_path)
+    with self.__lock:
+      entry = self.__lookup(kifu_id, stamp)
+      if entry is not None and entry['sgf'] is not None:
+        return entry['sgf']
+    if entry is None and stamp[1] is None:
+      # read outside of the lock, concurrent misses just read twice
+      sgf_str = read_sgf_file(path)
+      with self.__lock:
+        self.__store(kifu_id, {
+          'stamp': stamp,
+          'sgf': sgf_str,
+          'tree': None,
+          'index': None,
+          'length': len(sgf_str)
+        })
+      return sgf_str
+    # patched kifus are printed from their tree
+    if entry is None:
+      entry = self.__load(kifu_id, stamp, path, log_path, None)
+    sgf_str = SGF().print(entry['tree'])
+    with self.__lock:
+      if self.__entries.get(kifu_id) is entry:
+        entry['sgf'] = sgf_str
+    return sgf_str
+
+  # (root, index) of the parsed game tree of the kifu stored at path, where
+  # index maps node ids to nodes
+  def get_index(self, kifu_id, path, log_path=None):
+    stamp = self.__stamp(path, log_path)
+    with self.__lock:
+      entry = self.__lookup(kifu_id, stamp)
+      if entry is not None and entry['tree'] is not None:
+        return entry['tree'], entry['index']
+      sgf_str = None if entry is None else entry['sgf']
+    entry = self.__load(kifu_id, stamp, path, log_path, sgf_str)
+    return entry['tree'], entry['index']
+
+  # parsed game tree of the kifu stored at path
+  def get_tree(self, kifu_id, path, log_path=None):
+    return self.get_index(kifu_id, path, log_path)[0]
+
+  # new_root (with new_index) is a copy of the tree at root (returned by
+  # get_index) that was patched to match the files again, and replaces it
+  # instead of everything being parsed again
+  # its cost grows with the patch log, which may evict other entries
+  def patched(self, kifu_id, root, new_root, new_index, path, log_path):
+    stamp = self.__stamp(path, log_path)
+    with self.__lock:
+      entry = self.__entries.get(kifu_id)
+      if entry is not None and entry['tree'] is root:
+        old_log = 0 if entry['stamp'][1] is None else entry['stamp'][1][1]
+        new_log = 0 if stamp[1] is None else stamp[1][1]
+        self.__store(kifu_id, dict(
+          entry,
+          stamp=stamp,
+          sgf=None,
+          tree=new_root,
+          index=new_index,
+          length=entry['length'] - old_log + new_log
+        ))
+
+  def invalidate(self, kifu_id):
+    with self.__lock:
+      self.__discard(kifu_id)
+
+  def clear(self):
+    with self.__lock:
+      self.__entries.clear()
+      self.size = 0
+
+  @property
+  def stats(self):
+    with self.__lock:
+      return {
+        'entries': len(self.__entries),
+        'size': self.size,
+        'max_size': self.max_bytes,
+        'hits': self.hits,
+        'misses': self.misses
+      }
+
+# small thread-safe cache whose entries expire ttl seconds after being set
+# used for short-lived per-user data that is also invalidated explicitly
+class TimedCache:
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.__entries = {}
+    self.__lock = threading.Lock()
+
+  def get(self, key):
+    with self.__lock:
+      entry = self.__entries.get(key)
+      if entry is None:
+        return None
+      if entry[0] < time.monotonic():
+        del self.__entries[key]
+        return None
+      return entry[1]
+
+  def set(self, key, value):
+    with self.__lock:
+      self.__entries[key] = (time.monotonic() + self.ttl, value)
+      # drop expired entries once in a while so the dict stays small
+      if len(self.__entries) > 1024:
+        now = time.monotonic()
+        for k in [k for k, e in self.__entries.items() if e[0] < now]:
+          del self.__entries[k]
+
+  def invalidate(self, key):
+    with self.__lock:
+      self.__entries.pop(key, None)
@@ -0,0 +1,146 @@
+import threading, time, urllib.error, urllib.parse, urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+CHUNK_SIZE = 16 * 1024
+UTF8_BOM = b'\xef\xbb\xbf'
+
+class FetchError(Exception):
+  pass
+
+# the URL could not be fetched (bad URL, network error, timeout)
+class NetworkError(FetchError):
+  pass
+
+# the response is larger than the byte cap
+class TooLargeError(FetchError):
+  pass
+
+# the response does not look like an SGF file
+class NotSGFError(FetchError):
+  pass
+
+# too many fetches are already waiting
+class BusyError(FetchError):
+  pass
+
+# fetches SGF files from external URLs on a bounded thread pool
+# - responses are streamed and abandoned as soon as they exceed max_bytes
+#   or their first bytes do not look like SGF
+# - responses are cached for cache_ttl seconds, and revalidated with
+#   their ETag afterwards
+# - concurrent requests for the same URL share one fetch
+class SGFFetcher:
+  def __init__(self, workers, max_bytes, timeout, cache_ttl, cache_size=256):
+    self.workers = workers
+    self.max_bytes = max_bytes
+    self.timeout = timeout
+    self.cache_ttl = cache_ttl
+    self.cache_size = cache_size
+    self.__executor = ThreadPoolExecutor(max_workers=workers)
+    self.__lock = threading.Lock()
+    # url -> {'sgf', 'etag', 'expires'}, least recently used first
+    self.__cache = OrderedDict()
+    # url -> future of the fetch in progress
+    self.__inflight = {}
+
+  def __download(self, url, etag):
+    deadline = time.monotonic() + self.timeout
+    request = urllib.request.Request(url)
+    if etag is not None:
+      request.add_header('If-None-Match', etag)
+    try:
+      response = urllib.request.urlopen(request, timeout=self.timeout)
+    except urllib.error.HTTPError as e:
+      if e.code == 304 and etag is not None:
+        return None, etag
+      raise NetworkError(str(e))
+    except Exception as e:
+      raise NetworkError(str(e))
+
+    with response:
+      length = response.headers.get('Content-Length')
+      if length is not None and length.isdigit() and int(length) > self.max_bytes:
+        raise TooLargeError('Response too large: ' + length)
+      chunks = []
+      size = 0
+      checked = False
+      while True:
+        if time.monotonic() > deadline:
+          raise NetworkError('Timed out reading ' + url)
+        try:
+          chunk = response.read(CHUNK_SIZE)
+        except Exception as e:
+          raise NetworkError(str(e))
+        if not chunk:
+          break
+        size += len(chunk)
+        if size > self.max_bytes:
+          raise TooLargeError('Response too large')
+        chunks.append(chunk)
+        # reject as soon as the first non-whitespace byte is seen
+        if not checked:
+          head = b''.join(chunks)
+          if head.startswith(UTF8_BOM):
+            head = head[len(UTF8_BOM):]
+          head = head.lstrip()
+          if head:
+            if not head.startswith(b'('):
+              raise NotSGFError('Not an SGF file')
+            checked = True
+      if not checked:
+        raise NotSGFError('Empty response')
+
+    try:
+      sgf_str = b''.join(chunks).decode('utf-8-sig')
+    except UnicodeDecodeError:
+      raise NotSGFError('Not a UTF-8 text file')
+    return sgf_str, response.headers.get('ETag')
+
+  def __fetch(self, url, cached):
+    try:
+      etag = None if cached is None else cached['etag']
+      sgf_str, etag = self.__download(url, etag)
+      if sgf_str is None:
+        # not modified
+        sgf_str = cached['sgf']
+      with self.__lock:
+        self.__cache[url] = {
+          'sgf': sgf_str,
+          'etag': etag,
+          'expires': time.monotonic() + self.cache_ttl
+        }
+        self.__cache.move_to_end(url)
+        while len(self.__cache) > self.cache_size:
+          self.__cache.popitem(last=False)
+      return sgf_str
+    finally:
+      with self.__lock:
+        self.__inflight.pop(url, None)
+
+  # return the SGF string at url, or raise a FetchError
+  def fetch(self, url):
+    if urllib.parse.urlparse(url).scheme not in ('http', 'https'):
+      raise NetworkError('Unsupported URL: ' + url)
+
+    with self.__lock:
+      cached = self.__cache.get(url)
+      if cached is not None:
+        self.__cache.move_to_end(url)
+        if cached['expires'] > time.monotonic():
+          return cached['sgf']
+        # expired entries without an ETag cannot be revalidated
+        if cached['etag'] is None:
+          cached = None
+      future = self.__inflight.get(url)
+      if future is None:
+        # at most one waiting fetch per worker
+        if len(self.__inflight) >= 2 * self.workers:
+          raise BusyError('Too many external fetches')
+        future = self.__executor.submit(self.__fetch, url, cached)
+        self.__inflight[url] = future
+
+    try:
+      return future.result(timeout=self.timeout)
+    except TimeoutError:
+      raise NetworkError('Timed out fetching ' + url)
@@ -1,10 +1,25 @@
 from flask import current_app
 from flask_login import UserMixin
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import func
 
 import os
 
-from . import db, bcrypt
+from . import db, password_hasher, sgf_cache, sgf_store, notification_cache
+from .sgf import Node, SGF, SGFTooManyNodesError, copy_tree, parse_patch_op, apply_patch, validate_sub_sgf
+from .board import position_entries
+from .storage import SGFStore, locked_patch_log, append_patch_log, file_stamp, gzip_bytes, read_sgf_file
+
+# load usernames and ranks of many users with one joined query
+# returns {user_id: (username, rank_en)}, to be passed to the to_dict
+# methods below instead of querying each author separately
+def load_authors(user_ids):
+  user_ids = set(user_ids)
+  if len(user_ids) == 0:
+    return {}
+  rows = db.session.query(User.id, User.username, Rank.rank_en).outerjoin(Rank, User.rank_id==Rank.id).filter(User.id.in_(user_ids)).all()
+  return {row[0]: (row[1], row[2]) for row in rows}
 
 class User(UserMixin, db.Model):
   __tablename__ = 'users'
@@ -28,10 +43,10 @@ class User(UserMixin, db.Model):
 
   @password.setter
   def password(self, password):
-    self.password_hash = bcrypt.generate_password_hash(password)
+    self.password_hash = password_hasher.hash(password)
 
   def verify_password(self, password):
-    return bcrypt.check_password_hash(self.password_hash, password)
+    return password_hasher.verify(self.password_hash, password)
 
   def generate_confirmation_token(self, expiration=3600):
     s = Serializer(current_app.config['SECRET_KEY'], expiration)
@@ -50,9 +65,23 @@ class User(UserMixin, db.Model):
     db.session.commit()
     return True
 
+  # (count, latest serialized notifications) of the user's unread
+  # notifications, cached for a short while since it is shown on every page
+  def __unread(self):
+    unread = notification_cache.get(self.id)
+    if unread is None:
+      unread = load_unread_notifications(self.id, current_app.config['NOTIFICATION_LIMIT'])
+      notification_cache.set(self.id, unread)
+    return unread
+
+  @property
+  def unread_notification_count(self):
+    return self.__unread()[0]
+
+  # only the latest NOTIFICATION_LIMIT unread notifications
   @property
   def unread_notifications(self):
-    return [n.serialize for n in Notification.query.filter_by(receiver_id=self.id, read=False).order_by(Notification.id.desc()).all()]
+    return self.__unread()[1]
 
 class Role(db.Model):
   __tablename__ = 'roles'
@@ -76,13 +105,36 @@ class Kifu(db.Model):
   white_rank = db.Column(db.String(16), default='')
   komi = db.Column(db.String(8), default='')
   result = db.Column(db.String(16), default='')
+
+  # denormalized counts, updated together with the comments and stars
+  # run reconcile_counts.py to recompute them
+  comment_count = db.Column(db.Integer, default=0, nullable=False)
+  star_count = db.Column(db.Integer, default=0, nullable=False)
+
+  # hash of the standardized SGF in sgf_store, which keeps one compressed
+  # copy of each SGF for all kifus that share it
+  # kifus from before the store have none and use <id>.sgf instead, until
+  # migrate_sgf_store.py moves them into the store
+  sgf_hash = db.Column(db.String(64), index=True)
+
+  # indexes for the sort orders of the browse pages (keyset pagination)
+  __table_args__ = (
+    db.Index('ix_kifus_uploaded_on_id', 'uploaded_on', 'id'),
+    db.Index('ix_kifus_comment_count_id', 'comment_count', 'id'),
+    db.Index('ix_kifus_star_count_id', 'star_count', 'id'),
+    db.Index('ix_kifus_owner_id_uploaded_on', 'owner_id', 'uploaded_on')
+  )
   
+  # plain SGF file of kifus from before the SGF store (see sgf_hash)
+  @property
+  def legacy_filepath(self):
+    return legacy_sgf_path(self.id)
+
   @property
   def filepath(self):
-    return os.path.join(
-      current_app.config['SGF_FOLDER'],
-      str(self.id) + '.sgf'
-    )
+    if self.sgf_hash is None:
+      return self.legacy_filepath
+    return sgf_store.path(self.sgf_hash)
 
   @property
   def imagepath(self):
@@ -91,17 +143,74 @@ class Kifu(db.Model):
       str(self.id) + '.jpg'
     )
 
+  # operations patched onto the SGF since it was last stored
+  @property
+  def logpath(self):
+    return self.legacy_filepath + '.log'
+
+  # another request may have stored a new SGF and removed the old one
+  # since this kifu was loaded, in which case the new one is read
+  def __read_sgf(self, get):
+    try:
+      return get(self.id, self.filepath, self.logpath)
+    except FileNotFoundError:
+      if self.sgf_hash is None:
+        raise
+      self.__refresh_sgf_hash()
+      return get(self.id, self.filepath, self.logpath)
+
   @property
   def sgf(self):
-    with open(self.filepath, 'r') as f:
-      return f.read()
+    return self.__read_sgf(sgf_cache.get_sgf)
+
+  # parsed game tree of the SGF, shared through the cache (do not mutate)
+  @property
+  def sgf_tree(self):
+    return self.__read_sgf(sgf_cache.get_tree)
+
+  # (game tree, {node id: node}), shared through the cache (do not mutate)
+  @property
+  def sgf_index(self):
+    return self.__read_sgf(sgf_cache.get_index)
+
+  # gzipped SGF, which is the stored file itself unless it was patched
+  @property
+  def sgf_gzip(self):
+    log_stamp = file_stamp(self.logpath)
+    if self.sgf_hash is not None and (log_stamp is None or log_stamp[1] == 0):
+      try:
+        return sgf_store.get_gzip(self.sgf_hash)
+      except FileNotFoundError:
+        pass
+    return gzip_bytes(self.sgf.encode('utf-8'))
+
+  @property
+  def last_modified(self):
+    return self.modified_on or self.uploaded_on
+
+  # strong validator of the SGF that only needs the kifu row: storing a
+  # new SGF changes the hash, and patches change modified_on
+  @property
+  def sgf_etag(self):
+    return '%s-%s' % (
+      self.sgf_hash or 'legacy',
+      self.last_modified.strftime('%Y%m%d%H%M%S%f')
+    )
 
   @property
   def serialize(self):
+    return self.to_dict()
+
+  # authors is an optional map returned by load_authors
+  # the SGF is left out with with_sgf=False, e.g. for the kifu page, which
+  # loads it separately
+  def to_dict(self, authors=None, with_sgf=True):
+    if authors is None:
+      authors = load_authors([self.owner_id])
     uploaded_on = self.uploaded_on.strftime('%Y-%m-%d %H:%M:%S')
-    return {
+    kifu_dict = {
       'id': self.id,
-      'owner': User.query.get(self.owner_id).username,
+      'owner': authors[self.owner_id][0],
       'title': self.title,
       'description': self.description,
       'black_player': self.black_player,
@@ -110,13 +219,124 @@ class Kifu(db.Model):
       'white_rank': self.white_rank,
       'komi': self.komi,
       'result': self.result,
-      'uploaded_on': uploaded_on,
-      'sgf': self.sgf
+      'uploaded_on': uploaded_on
     }
+    if with_sgf:
+      kifu_dict['sgf'] = self.sgf
+    return kifu_dict
+
+  # newSGF is either an SGF string or the root of a parsed game tree
+  # any patch log is dropped, since the new SGF contains all the patched
+  # nodes, and the kifu is committed
+  # if validate is True, newSGF must contain the whole current tree (see
+  # validate_sub_sgf), checked under the patch log lock so that no patch
+  # is lost in between, and ValueError is raised otherwise
+  def update_sgf(self, newSGF, validate=False):
+    with locked_patch_log(self.logpath) as log:
+      self.__refresh_sgf_hash()
+      if validate and not validate_sub_sgf(newSGF, self.sgf_tree):
+        raise ValueError('New SGF does not contain the current SGF')
+      if isinstance(newSGF, Node):
+        newSGF = SGF().print(newSGF)
+      self.__store_sgf(newSGF)
+      log.truncate(0)
+
+  # add new nodes to the SGF without rewriting it
+  # ops is a list of {'parent': id, 'sgf': str}, adding the game trees
+  # in sgf (whose nodes all have new IDs) under the node with id parent
+  # the ops are validated against a copy of the cached tree, appended to
+  # the patch log and applied to the copy, which then replaces the cached
+  # tree, so that readers of the cached tree never see a patch half way
+  # the log is compacted into a new stored SGF once it grows past
+  # SGF_PATCH_LOG_MAX bytes
+  # returns the patched tree (shared through the cache, do not mutate),
+  # raises ValueError if an op is invalid
+  # sgf is the parser for the operations, whose node limit also bounds
+  # the patched tree
+  def patch_sgf(self, ops, sgf=None):
+    with locked_patch_log(self.logpath) as log:
+      self.__refresh_sgf_hash()
+      cached_root, cached_index = sgf_cache.get_index(self.id, self.filepath, self.logpath)
+      root, index = copy_tree(cached_root)
+      added = {}
+      parsed_ops = [
+        parse_patch_op(index, added, op['parent'], op['sgf'], sgf) for op in ops
+      ]
+      max_nodes = None if sgf is None else sgf.max_nodes
+      if max_nodes is not None and len(index) + len(added) > max_nodes:
+        raise SGFTooManyNodesError('More than %d nodes' % max_nodes)
+      append_patch_log(log, ops)
+      apply_patch(index, added, parsed_ops)
+      sgf_cache.patched(self.id, cached_root, root, index, self.filepath, self.logpath)
+      index_kifu_positions(self.id, root, [
+        child for parent, children in parsed_ops for child in children
+      ])
+      if log.tell() > current_app.config['SGF_PATCH_LOG_MAX']:
+        self.__compact(log, root)
+    return root
+
+  # write the patched tree as a new stored SGF and empty the patch log,
+  # e.g. from compact_sgf.py, so that the stored gzipped SGF is sent again
+  # does nothing if the kifu was not patched since
+  def compact_sgf(self):
+    log_stamp = file_stamp(self.logpath)
+    if log_stamp is None or log_stamp[1] == 0:
+      return
+    with locked_patch_log(self.logpath) as log:
+      if os.fstat(log.fileno()).st_size == 0:
+        # compacted by another request meanwhile
+        return
+      self.__refresh_sgf_hash()
+      self.__compact(log, self.sgf_tree)
+
+  # must hold the patch log lock
+  def __compact(self, log, root):
+    self.__store_sgf(SGF().print(root))
+    log.truncate(0)
 
-  def update_sgf(self, newSGF):
-    with open(self.filepath, 'w') as f:
-      f.write(newSGF)
+  # another request may have stored a new SGF since this kifu was loaded,
+  # so writers read the committed hash again under the patch log lock
+  # it is set as the loaded value, so the kifu is not made dirty
+  def __refresh_sgf_hash(self):
+    sgf_hash = db.session.query(Kifu.sgf_hash) \
+      .filter(Kifu.id == self.id).with_for_update().scalar()
+    set_committed_value(self, 'sgf_hash', sgf_hash)
+
+  # point the kifu at sgf_str in the store and commit, must hold the
+  # patch log lock
+  def __store_sgf(self, sgf_str):
+    old_hash = self.sgf_hash
+    new_hash = SGFStore.hash(sgf_str)
+    with sgf_store.locked(new_hash):
+      sgf_store.put(new_hash, sgf_str)
+      self.sgf_hash = new_hash
+      db.session.add(self)
+      db.session.commit()
+    sgf_cache.invalidate(self.id)
+    if old_hash is not None and old_hash != new_hash:
+      release_sgf_blob(old_hash)
+
+def legacy_sgf_path(kifu_id):
+  return os.path.join(current_app.config['SGF_FOLDER'], str(kifu_id) + '.sgf')
+
+# SGF of a kifu from its id and hash alone, e.g. for exports that read many
+# kifus from one query without loading them
+# unpatched kifus are read straight from their file instead of through the
+# cache, so that an export does not push out the kifus being viewed
+def read_kifu_sgf(kifu_id, sgf_hash):
+  legacy_path = legacy_sgf_path(kifu_id)
+  path = legacy_path if sgf_hash is None else sgf_store.path(sgf_hash)
+  log_stamp = file_stamp(legacy_path + '.log')
+  if log_stamp is None or log_stamp[1] == 0:
+    return read_sgf_file(path)
+  return sgf_cache.get_sgf(kifu_id, path, legacy_path + '.log')
+
+# remove the stored SGF with sgf_hash once no kifu refers to it anymore
+# the kifus with the hash are its references, counted through the index
+def release_sgf_blob(sgf_hash):
+  with sgf_store.locked(sgf_hash):
+    if Kifu.query.filter_by(sgf_hash=sgf_hash).count() == 0:
+      sgf_store.remove(sgf_hash)
 
 class Comment(db.Model):
   __tablename__ = 'comments'
@@ -127,15 +347,27 @@ class Comment(db.Model):
   kifu_id = db.Column(db.Integer, db.ForeignKey('kifus.id'), nullable=False)
   node_id = db.Column(db.Integer, nullable=False)
 
+  # comments of a kifu are read per node (or node range) in time order
+  __table_args__ = (
+    db.Index('ix_comments_kifu_id_node_id_timestamp', 'kifu_id', 'node_id', 'timestamp'),
+  )
+
   @property
   def serialize(self):
+    return self.to_dict()
+
+  # authors is an optional map returned by load_authors
+  def to_dict(self, authors=None):
+    if authors is None:
+      authors = load_authors([self.author])
+    username, rank = authors[self.author]
     return {
       'id': self.id,
       'content': self.content,
       'timestamp': self.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
       'author_id': self.author,
-      'author_username': User.query.get(self.author).username,
-      'author_rank': User.query.get(self.author).rank,
+      'author_username': username,
+      'author_rank': rank,
       'kifu_id': self.kifu_id,
       'node_id': self.node_id
     }
@@ -144,7 +376,58 @@ class KifuStar(db.Model):
   __tablename__='kifustars'
   id = db.Column(db.Integer, primary_key=True)
   user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-  kifu_id = db.Column(db.Integer, db.ForeignKey('kifus.id'), nullable=False)
+  kifu_id = db.Column(db.Integer, db.ForeignKey('kifus.id'), nullable=False, index=True)
+
+  __table_args__ = (
+    db.Index('ix_kifustars_user_id_kifu_id', 'user_id', 'kifu_id'),
+  )
+
+# positions reached in each kifu by Zobrist hash (see board.py), so that
+# the kifus that reached a position are found with an index lookup
+# only the first node of a kifu that reaches a position is kept
+# run index_positions.py to index kifus from before the table
+class Position(db.Model):
+  __tablename__ = 'positions'
+  id = db.Column(db.Integer, primary_key=True)
+  kifu_id = db.Column(db.Integer, db.ForeignKey('kifus.id'), nullable=False, index=True)
+  node_id = db.Column(db.Integer, nullable=False)
+  hash = db.Column(db.BigInteger, nullable=False)
+  # the same for all 8 rotations and reflections of the position
+  normalized_hash = db.Column(db.BigInteger, nullable=False)
+
+  __table_args__ = (
+    db.Index('ix_positions_hash_kifu_id', 'hash', 'kifu_id'),
+    db.Index('ix_positions_normalized_hash_kifu_id', 'normalized_hash', 'kifu_id')
+  )
+
+# index the positions of the kifu with the game tree at root, replacing
+# its entries, or only adding those of the subtrees of nodes (e.g. nodes
+# just patched in)
+# does not commit
+def index_kifu_positions(kifu_id, root, nodes=None):
+  if nodes is None:
+    Position.query.filter_by(kifu_id=kifu_id).delete(synchronize_session=False)
+    seen = None
+  else:
+    rows = db.session.query(Position.hash, Position.normalized_hash) \
+      .filter(Position.kifu_id == kifu_id).all()
+    seen = (set(r[0] for r in rows), set(r[1] for r in rows))
+  db.session.bulk_insert_mappings(Position, [{
+    'kifu_id': kifu_id,
+    'node_id': node_id,
+    'hash': h,
+    'normalized_hash': normalized
+  } for node_id, h, normalized in position_entries(root, nodes, seen)])
+
+# (kifu id, node id) of the kifus that reached the position with hash h
+# (a normalized hash if normalized is True), by kifu id after after
+def search_positions(h, normalized=False, after=0, limit=20, exclude_kifu_id=None):
+  column = Position.normalized_hash if normalized else Position.hash
+  query = db.session.query(Position.kifu_id, func.min(Position.node_id)) \
+    .filter(column == h, Position.kifu_id > after)
+  if exclude_kifu_id is not None:
+    query = query.filter(Position.kifu_id != exclude_kifu_id)
+  return query.group_by(Position.kifu_id).order_by(Position.kifu_id).limit(limit).all()
 
 class Rank(db.Model):
   __tablename__ = 'ranks'
@@ -159,17 +442,27 @@ class Notification(db.Model):
   # category == 2: a node that user commented on received another comment
   category = db.Column(db.Integer, nullable=False)
   # user receiving the notification
-  receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+  receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
   # comment that triggered the notification
   # from the comment, kifu_id, node_id, and commenter_id will be known
-  comment_id = db.Column(db.Integer, db.ForeignKey('comments.id'), nullable=False)
+  comment_id = db.Column(db.Integer, db.ForeignKey('comments.id'), nullable=False, index=True)
   # whether notification has already been read
   read = db.Column(db.Boolean, default=False)
 
   @property
   def serialize(self):
-    comment = Comment.query.get(self.comment_id)
-    kifu = Kifu.query.get(comment.kifu_id)
+    return self.to_dict()
+
+  # comment, kifu_title and authors (see load_authors) are queried
+  # if they are not passed in
+  def to_dict(self, comment=None, kifu_title=None, authors=None):
+    if comment is None:
+      comment = Comment.query.get(self.comment_id)
+    if kifu_title is None:
+      kifu_title = db.session.query(Kifu.title).filter(Kifu.id==comment.kifu_id).scalar()
+    if authors is None:
+      authors = load_authors([comment.author])
+    username, rank = authors[comment.author]
     return {
       'id': self.id,
       'category': self.category,
@@ -177,9 +470,53 @@ class Notification(db.Model):
       'comment_id': self.comment_id,
       'content': comment.content,
       'timestamp': comment.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-      'kifu_id': kifu.id,
-      'kifu_title': kifu.title,
+      'kifu_id': comment.kifu_id,
+      'kifu_title': kifu_title,
       'node_id': comment.node_id,
-      'author_username': User.query.get(comment.author).username,
-      'author_rank': User.query.get(comment.author).rank
+      'author_username': username,
+      'author_rank': rank
     }
+
+# map node id -> number of comments on the node, for the nodes of a kifu
+# that have comments
+def load_comment_counts(kifu_id):
+  rows = db.session.query(Comment.node_id, func.count(Comment.id)) \
+    .filter(Comment.kifu_id == kifu_id).group_by(Comment.node_id).all()
+  return {node_id: count for node_id, count in rows}
+
+# count a user's unread notifications and serialize the latest limit ones
+# together with their comments, kifu titles and authors in one joined query
+def load_unread_notifications(user_id, limit):
+  unread = db.session.query(Notification).filter(
+    Notification.receiver_id==user_id,
+    Notification.read==False
+  )
+  count = unread.with_entities(func.count(Notification.id)).scalar()
+  if count == 0:
+    return 0, []
+  rows = unread.with_entities(
+    Notification, Comment, Kifu.title, User.username, Rank.rank_en
+  ).join(
+    Comment, Notification.comment_id==Comment.id
+  ).join(
+    Kifu, Comment.kifu_id==Kifu.id
+  ).join(
+    User, Comment.author==User.id
+  ).outerjoin(
+    Rank, User.rank_id==Rank.id
+  ).order_by(Notification.id.desc()).limit(limit).all()
+  return count, [
+    n.to_dict(c, title, {c.author: (username, rank)})
+    for n, c, title, username, rank in rows
+  ]
+
+# recompute the denormalized comment and star counts of every kifu
+def reconcile_kifu_counts():
+  comment_count = db.session.query(func.count(Comment.id)).filter(Comment.kifu_id==Kifu.id).as_scalar()
+  star_count = db.session.query(func.count(KifuStar.id)).filter(KifuStar.kifu_id==Kifu.id).as_scalar()
+  updated = Kifu.query.update({
+    Kifu.comment_count: comment_count,
+    Kifu.star_count: star_count
+  }, synchronize_session=False)
+  db.session.commit()
+  return updated
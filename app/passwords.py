@@ -0,0 +1,80 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+# too many password checks are already waiting for a worker
+class PasswordBusyError(Exception):
+  pass
+
+# these run in worker processes
+def hash_password(password, rounds):
+  return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def check_password(pw_hash, password):
+  if isinstance(pw_hash, str):
+    pw_hash = pw_hash.encode('utf-8')
+  return bcrypt.checkpw(password.encode('utf-8'), pw_hash)
+
+# cost factor stored in a hash such as '$2b$15$...'
+def hash_rounds(pw_hash):
+  if isinstance(pw_hash, bytes):
+    pw_hash = pw_hash.decode('utf-8')
+  try:
+    return int(pw_hash.split('$')[2])
+  except (IndexError, ValueError):
+    return -1
+
+# hashes and verifies passwords in a bounded process pool so that bcrypt
+# does not hold up request threads
+# verifications (logins) are refused with PasswordBusyError once
+# max_pending of them are waiting, while hashing (sign ups) always waits
+# with 0 workers, everything runs in the calling thread
+class PasswordHasher:
+  def __init__(self, workers, rounds, max_pending):
+    self.workers = workers
+    self.rounds = rounds
+    self.max_pending = max_pending
+    self.pending = 0
+    self.completed = 0
+    self.rejected = 0
+    self.__executor = None
+    self.__lock = threading.Lock()
+
+  def __run(self, fn, *args, login=False):
+    if self.workers == 0:
+      return fn(*args)
+    with self.__lock:
+      if login and self.pending >= self.max_pending:
+        self.rejected += 1
+        raise PasswordBusyError('Too many logins in progress')
+      if self.__executor is None:
+        self.__executor = ProcessPoolExecutor(max_workers=self.workers)
+      self.pending += 1
+    try:
+      return self.__executor.submit(fn, *args).result()
+    finally:
+      with self.__lock:
+        self.pending -= 1
+        self.completed += 1
+
+  def hash(self, password):
+    return self.__run(hash_password, password, self.rounds)
+
+  def verify(self, pw_hash, password):
+    return self.__run(check_password, pw_hash, password, login=True)
+
+  # whether pw_hash was made with a different cost than the configured one
+  def needs_rehash(self, pw_hash):
+    return hash_rounds(pw_hash) != self.rounds
+
+  @property
+  def stats(self):
+    with self.__lock:
+      return {
+        'workers': self.workers,
+        'pending': self.pending,
+        'max_pending': self.max_pending,
+        'completed': self.completed,
+        'rejected': self.rejected
+      }
@@ -0,0 +1,201 @@
+import re
+
+from sqlalchemy import text
+
+# full-text search over kifus (title, player names and description) and
+# comments, with an inverted index kept in the database next to them:
+# - SQLite (development) uses an FTS5 table, and text is tokenized here
+# - MySQL (production) uses a FULLTEXT index with the ngram parser, which
+#   tokenizes the text itself
+# both index documents by rowid, ref_id * 2 + kind, so a document is
+# replaced or removed without a scan
+# writes go through the session, so they are committed (or rolled back)
+# together with the rows they index
+
+KIFU = 0
+COMMENT = 1
+KINDS = {'kifu': KIFU, 'comment': COMMENT}
+
+def document_id(kind, ref_id):
+  return ref_id * 2 + kind
+
+# chinese, japanese and korean characters, which are not separated by spaces
+CJK = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+')
+WORD = re.compile(r'\w+')
+
+# lowercase words, with runs of CJK characters split into overlapping
+# bigrams (a single character stays as is), e.g. '柯洁 vs Shin' gives
+# ['柯洁', 'vs', 'shin'] and '围棋定式' gives ['围棋', '棋定', '定式']
+# with unigrams=True (for indexed text) every character of a longer run
+# is added as well, so that a single character is found anywhere in it
+def tokenize(s, unigrams=False):
+  tokens = []
+  for word in WORD.findall(s.lower()):
+    start = 0
+    for m in CJK.finditer(word):
+      if m.start() > start:
+        tokens.append(word[start:m.start()])
+      run = m.group()
+      if len(run) == 1:
+        tokens.append(run)
+      else:
+        tokens.extend(run[i:i+2] for i in range(len(run) - 1))
+        if unigrams:
+          tokens.extend(run)
+      start = m.end()
+    if start < len(word):
+      tokens.append(word[start:])
+  return tokens
+
+class SQLiteBackend:
+  def create(self, session):
+    session.execute(text(
+      "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts "
+      "USING fts5(title, body, tokenize='unicode61 remove_diacritics 2')"
+    ))
+
+  def drop(self, session):
+    session.execute(text('DROP TABLE IF EXISTS search_fts'))
+
+  # docs are (document id, title, body)
+  def put(self, session, docs):
+    session.execute(text('DELETE FROM search_fts WHERE rowid = :id'), [
+      {'id': doc_id} for doc_id, title, body in docs
+    ])
+    session.execute(text(
+      'INSERT INTO search_fts (rowid, title, body) VALUES (:id, :title, :body)'
+    ), [{
+      'id': doc_id,
+      'title': ' '.join(tokenize(title, unigrams=True)),
+      'body': ' '.join(tokenize(body, unigrams=True))
+    } for doc_id, title, body in docs])
+
+  def delete_where(self, session, id_query, params):
+    session.execute(text('DELETE FROM search_fts WHERE rowid IN (%s)' % id_query), params)
+
+  # every token must match
+  def search(self, session, query, kind, offset, limit):
+    terms = ['"%s"' % t for t in tokenize(query)]
+    if len(terms) == 0:
+      return []
+    sql = 'SELECT rowid FROM search_fts WHERE search_fts MATCH :match'
+    if kind is not None:
+      sql += ' AND rowid % 2 = :kind'
+    # matches in the title count twice as much
+    sql += ' ORDER BY bm25(search_fts, 2.0, 1.0) LIMIT :limit OFFSET :offset'
+    rows = session.execute(text(sql), {
+      'match': ' '.join(terms),
+      'kind': kind,
+      'limit': limit,
+      'offset': offset
+    })
+    return [r[0] for r in rows]
+
+class MySQLBackend:
+  # the ngram parser indexes every 2 characters (ngram_token_size), which
+  # finds CJK words, and short words that the default parser leaves out
+  def create(self, session):
+    session.execute(text(
+      'CREATE TABLE IF NOT EXISTS search_documents ('
+      'id BIGINT NOT NULL PRIMARY KEY, '
+      'title TEXT NOT NULL, '
+      'body MEDIUMTEXT NOT NULL, '
+      'FULLTEXT KEY ft_search_documents (title, body) WITH PARSER ngram'
+      ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci'
+    ))
+
+  def drop(self, session):
+    session.execute(text('DROP TABLE IF EXISTS search_documents'))
+
+  def put(self, session, docs):
+    session.execute(text(
+      'REPLACE INTO search_documents (id, title, body) VALUES (:id, :title, :body)'
+    ), [
+      {'id': doc_id, 'title': title, 'body': body} for doc_id, title, body in docs
+    ])
+
+  def delete_where(self, session, id_query, params):
+    session.execute(text('DELETE FROM search_documents WHERE id IN (%s)' % id_query), params)
+
+  # every word must match, as a phrase of its ngrams
+  def search(self, session, query, kind, offset, limit):
+    words = [w.replace('"', '') for w in query.split()]
+    against = ' '.join('+"%s"' % w for w in words if w)
+    if against == '':
+      return []
+    sql = 'SELECT id FROM search_documents ' \
+      'WHERE MATCH (title, body) AGAINST (:against IN BOOLEAN MODE)'
+    if kind is not None:
+      sql += ' AND id % 2 = :kind'
+    sql += ' ORDER BY MATCH (title, body) AGAINST (:against IN BOOLEAN MODE) DESC ' \
+      'LIMIT :limit OFFSET :offset'
+    rows = session.execute(text(sql), {
+      'against': against,
+      'kind': kind,
+      'limit': limit,
+      'offset': offset
+    })
+    return [r[0] for r in rows]
+
+BACKENDS = {
+  'sqlite': SQLiteBackend,
+  'mysql': MySQLBackend
+}
+
+# the search index of the app's database, whose backend is picked by the
+# database in use the first time it is needed (in an app context)
+class SearchIndex:
+  def __init__(self, db):
+    self.db = db
+    self.__backend = None
+
+  @property
+  def backend(self):
+    if self.__backend is None:
+      self.__backend = BACKENDS[self.db.engine.dialect.name]()
+    return self.__backend
+
+  def create(self):
+    self.backend.create(self.db.session)
+
+  def drop(self):
+    self.backend.drop(self.db.session)
+
+  # kifus are (id, title, black player, white player, description)
+  def index_kifus(self, kifus):
+    if len(kifus) > 0:
+      self.backend.put(self.db.session, [(
+        document_id(KIFU, kifu_id),
+        ' '.join((title, black_player or '', white_player or '')),
+        description or ''
+      ) for kifu_id, title, black_player, white_player, description in kifus])
+
+  def index_kifu(self, kifu):
+    self.index_kifus([(kifu.id, kifu.title, kifu.black_player, kifu.white_player, kifu.description)])
+
+  # comments are (id, content)
+  def index_comments(self, comments):
+    if len(comments) > 0:
+      self.backend.put(self.db.session, [
+        (document_id(COMMENT, comment_id), '', content) for comment_id, content in comments
+      ])
+
+  def index_comment(self, comment):
+    self.index_comments([(comment.id, comment.content)])
+
+  # remove a kifu and the comments on it, before the comments are deleted
+  def remove_kifu(self, kifu_id):
+    self.backend.delete_where(self.db.session, ':kifu_doc', {'kifu_doc': document_id(KIFU, kifu_id)})
+    self.backend.delete_where(
+      self.db.session,
+      'SELECT id * 2 + %d FROM comments WHERE kifu_id = :kifu_id' % COMMENT,
+      {'kifu_id': kifu_id}
+    )
+
+  # (kind, id) of the best matches of query, best first, of one kind
+  # ('kifu' or 'comment') or of both
+  def search(self, query, kind=None, offset=0, limit=20):
+    doc_ids = self.backend.search(
+      self.db.session, query, None if kind is None else KINDS[kind], offset, limit
+    )
+    return [(doc_id % 2, doc_id // 2) for doc_id in doc_ids]
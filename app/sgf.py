@@ -1,30 +1,96 @@
+import io, re
+
 # the Node and SGF classes are just a re-write of sgf.js
+# actions are stored as parallel lists of props and values instead of
+# one dict per action, and __slots__ drops the per-node __dict__
 class Node:
+  __slots__ = ('id', 'parent', 'children', 'props', 'values')
+
   def __init__(self, parent):
     self.id = -1
     self.parent = parent
     self.children = []
-    self.actions = []
+    self.props = []
+    self.values = []
 
   def add_child(self, child):
     self.children.append(child)
 
   def add_action(self, prop, val):
-    self.actions.append({
-      'prop': prop,
-      'value': val
-    })
+    self.props.append(prop)
+    self.values.append(val)
+
+  # (prop, value) pairs of the node's actions
+  def action_pairs(self):
+    return zip(self.props, self.values)
+
+  # compatibility view of the actions as a list of dicts, as in sgf.js
+  # the list is built on every access, so mutating it has no effect
+  @property
+  def actions(self):
+    return [{'prop': p, 'value': v} for p, v in zip(self.props, self.values)]
+
+  @actions.setter
+  def actions(self, actions):
+    self.props = [action['prop'] for action in actions]
+    self.values = [action['value'] for action in actions]
+
+# characters that end the property name being read inside a node
+_NODE_DELIM_RE = re.compile(r'[;()\[]')
+# characters that matter inside a property value
+_VALUE_END_RE = re.compile(r'[\\\]]')
+
+# whether s[i] is escaped by the run of \ before it
+def _escaped(s, i):
+  j = i
+  while j > 0 and s[j-1] == '\\':
+    j -= 1
+  return (i - j) % 2 == 1
+
+# raised when an SGF string goes over one of the parser's limits
+class SGFLimitError(ValueError):
+  pass
+
+# more than max_bytes bytes (UTF-8)
+class SGFTooLargeError(SGFLimitError):
+  pass
+
+# more than max_nodes nodes
+class SGFTooManyNodesError(SGFLimitError):
+  pass
+
+# variations nested more than max_depth deep
+class SGFTooDeepError(SGFLimitError):
+  pass
+
+# a property value longer than max_value_length
+class SGFValueTooLongError(SGFLimitError):
+  pass
 
 class SGF:
-  def __init__(self):
+  # legacy=True switches back to the original split-based parser,
+  # which is kept around to check the single-pass tokenizer against it
+
+  # limits are None (no limit) by default, they are meant for SGF sent by
+  # clients and are checked while tokenizing, so that input over a limit
+  # is rejected without reading the rest of it
+  # (the legacy parser only checks max_bytes)
+  def __init__(self, legacy=False, max_bytes=None, max_nodes=None, max_depth=None, max_value_length=None):
     self.max_node_id = -1
-
+    self.legacy = legacy
+    self.max_bytes = max_bytes
+    self.max_nodes = max_nodes
+    self.max_depth = max_depth
+    self.max_value_length = max_value_length
+
+  # index of the first ] that is not escaped, that is not preceded by an
+  # odd number of \ (\\ is an escaped \), as in the tokenizer and sgf.js
   def __no_escape_bracket_index(self, s, start):
     nebi = s.find(']', start)
     if nebi == -1:
       return -1
 
-    while nebi != -1 and s[nebi-1] == '\\':
+    while nebi != -1 and _escaped(s, nebi):
       start = nebi + 1
       nebi = s.find(']', start)
 
@@ -58,10 +124,10 @@ class SGF:
     node_str_list = self.__sem_valid_split(sgf_str, ';')
     for i in range(1, len(node_str_list)):
       node = Node(parent)
-      node.actions = self.__parse_actions(node_str_list[i])
+      actions = self.__parse_actions(node_str_list[i])
       # handle id stored as an action
-      for j in range(0, len(node.actions)):
-        action = node.actions[j]
+      for j in range(0, len(actions)):
+        action = actions[j]
         if (action['prop'] == 'ID'):
           id = int(action['value']) # exception could be thrown
           if id < 0:
@@ -69,8 +135,9 @@ class SGF:
           node.id = id
           if id > self.max_node_id:
             self.max_node_id = id
-          del node.actions[j]
+          del actions[j]
           break
+      node.actions = actions
       parent.add_child(node)
       parent = node
 
@@ -167,22 +234,137 @@ class SGF:
       else:
         raise ValueError('Invalid SGF String')
 
+  # single left-to-right pass over sgf_str
+  # an explicit stack replaces the recursion on variations, and values
+  # are the only substrings ever copied out of sgf_str
+  def __tokenize(self, sgf_str, root):
+    n = len(sgf_str)
+    i = 0
+    parent = root
+    # parents to return to when a variation is closed
+    stack = []
+    # node being read, None while between sequences
+    node = None
+    # set once a [ without a matching ] is seen, so the rest of
+    # the string is not searched for ] over and over again
+    unclosed = False
+    node_count = 0
+    max_nodes = self.max_nodes
+    max_depth = self.max_depth
+    max_value_length = self.max_value_length
+
+    while i < n:
+      if node is None:
+        c = sgf_str[i]
+        if c.isspace():
+          pass
+        elif c == '(':
+          if max_depth is not None and len(stack) >= max_depth:
+            raise SGFTooDeepError('Variations nested deeper than %d' % max_depth)
+          stack.append(parent)
+        elif c == ')':
+          # unmatched close parentheses are skipped
+          if stack:
+            parent = stack.pop()
+        elif c == ';':
+          node_count += 1
+          if max_nodes is not None and node_count > max_nodes:
+            raise SGFTooManyNodesError('More than %d nodes' % max_nodes)
+          node = Node(parent)
+          prop_start = i + 1
+          last_prop = ''
+          has_id = False
+        else:
+          raise ValueError('Invalid SGF String')
+        i += 1
+        continue
+
+      # inside a node, jump to the next delimiter
+      m = _NODE_DELIM_RE.search(sgf_str, i)
+      if m is None:
+        # sequence is never terminated by ( or )
+        raise ValueError('Invalid SGF String')
+      j = m.start()
+      c = sgf_str[j]
+
+      if c == '[':
+        # find the closing ], skipping the character after every \, so
+        # that \] is an escaped bracket and \\] an escaped \ and then the end
+        # with a value length limit, ] is only searched for that far
+        stop = n if max_value_length is None else min(n, j + 2 + max_value_length)
+        end = -1
+        k = j + 1
+        while not unclosed:
+          m = _VALUE_END_RE.search(sgf_str, k, stop)
+          if m is None:
+            break
+          k = m.start()
+          if sgf_str[k] == ']':
+            end = k
+            break
+          k += 2
+        if end == -1:
+          if stop < n:
+            raise SGFValueTooLongError('Property value longer than %d' % max_value_length)
+          unclosed = True
+          i = j + 1
+          continue
+        prop = sgf_str[prop_start:j].strip().upper()
+        if prop == '':
+          prop = last_prop
+        last_prop = prop
+        value = sgf_str[j+1:end].strip()
+        # handle id stored as an action
+        if prop == 'ID' and not has_id:
+          id = int(value) # exception could be thrown
+          if id < 0:
+            raise ValueError('Invalid ID: ' + value)
+          node.id = id
+          if id > self.max_node_id:
+            self.max_node_id = id
+          has_id = True
+        else:
+          node.add_action(prop, value)
+        i = end + 1
+        prop_start = i
+      else:
+        # ; ( or ) closes the current node, and is then handled
+        # by the between-nodes branch above
+        parent.add_child(node)
+        parent = node
+        node = None
+        i = j
+
+    if node is not None or stack:
+      raise ValueError('Invalid SGF String')
+
+  # number the nodes in preorder, with an explicit stack so that long
+  # games do not hit the recursion limit
   def add_id(self, root):
     id = 0
-
-    def helper(root):
-      nonlocal id
-      root.id = id
+    stack = [root]
+    while stack:
+      node = stack.pop()
+      node.id = id
       id += 1
-      for child in root.children:
-        helper(child)
-
-    helper(root)
+      stack.extend(reversed(node.children))
     return id
 
+  def __check_size(self, sgf_str):
+    max_bytes = self.max_bytes
+    if max_bytes is None:
+      return
+    # a str is at least as long in UTF-8, so it is only encoded when needed
+    if len(sgf_str) > max_bytes or len(sgf_str.encode('utf-8')) > max_bytes:
+      raise SGFTooLargeError('SGF larger than %d bytes' % max_bytes)
+
   def parse(self, sgf_str):
+    self.__check_size(sgf_str)
     root = Node(None)
-    self.__parse_helper(sgf_str, root, 0)
+    if self.legacy:
+      self.__parse_helper(sgf_str, root, 0)
+    else:
+      self.__tokenize(sgf_str, root)
 
     # if parsing a new kifu (ID tags not added yet)
     if (self.max_node_id == -1):
@@ -193,149 +375,263 @@ class SGF:
     self.max_node_id = -1
     return root
 
-  def print(self, root):
-    sgf_str = ''
-    
-    def helper(node):
-      nonlocal sgf_str
-      # each variation starts with (
-      sgf_str += '('
+  # write the SGF string of a game tree to a file object
+  # an explicit stack is used instead of recursion so that deeply
+  # nested variations do not hit the recursion limit
+  def print_to(self, root, f):
+    write = f.write
+
+    def write_node(node):
       # print actions
-      for i in range(len(node.actions)):
-        action = node.actions[i]
+      props = node.props
+      values = node.values
+      for i in range(len(props)):
         if i == 0:
-          sgf_str += ';'
-        sgf_str += action['prop'] + '[' + action['value'] + ']'
+          write(';')
+        write(props[i] + '[' + values[i] + ']')
       # print id
       if node.id != -1:
         # in case the node has no actions
-        if len(node.actions) == 0:
-          sgf_str += ';'
-        sgf_str += 'ID' + '[' + str(node.id) + ']'
+        if len(props) == 0:
+          write(';')
+        write('ID[' + str(node.id) + ']')
+
+    # None marks the end of a variation
+    stack = [root]
+    while stack:
+      node = stack.pop()
+      if node is None:
+        # close off the variation
+        write(')')
+        continue
+      # each variation starts with (
+      write('(')
+      write_node(node)
       # as long as there is only one variation
       while len(node.children) == 1:
         node = node.children[0]
-        # print actions (see above)
-        for i in range(len(node.actions)):
-          action = node.actions[i]
-          if i == 0:
-            sgf_str += ';'
-          sgf_str += action['prop'] + '[' + action['value'] + ']'
-        # print id (see above)
-        if node.id != -1:
-          # in case the node has no actions
-          if len(node.actions) == 0:
-            sgf_str += ';'
-          sgf_str += 'ID' + '[' + str(node.id) + ']'
-      # more than one branch
-      for child in node.children:
-        helper(child)
-      # close off the variation
-      sgf_str += ')'
-    
-    helper(root)
-    return sgf_str
+        write_node(node)
+      # more than one branch, printed in order after this one is closed
+      stack.append(None)
+      stack.extend(reversed(node.children))
+
+  def print(self, root):
+    buf = io.StringIO()
+    self.print_to(root, buf)
+    return buf.getvalue()
 
 # check if the sgf_str is syntactically valid
-def validate_sgf(sgf_str):
-  sgf = SGF()
+# parse errors are ValueErrors, anything else (e.g. sgf_str that is not a
+# string) makes it invalid too
+def validate_sgf(sgf_str, sgf=None):
+  if sgf is None:
+    sgf = SGF()
   try:
-    root = sgf.parse(sgf_str)
+    sgf.parse(sgf_str)
     return True
   except Exception as e:
     print(e)
     return False
 
+# frozenset of the (prop, value) action pairs of a node
+def action_set(node):
+  return frozenset(node.action_pairs())
+
 # helper function to verify that one node is a "sub_node" of another node
-def validate_sub_node(node, sub_node):
+# action sets can be passed in when they have already been computed
+def validate_sub_node(node, sub_node, actions=None, sub_actions=None):
   # must have the same ID
   if node.id != sub_node.id:
     return False
   # node must contain all of sub_node's actions
-  if len(node.actions) < len(sub_node.actions):
+  if len(node.props) < len(sub_node.props):
     return False
-  for sub_action in sub_node.actions:
-    found = False
-    for action in node.actions:
-      if action['prop'] == sub_action['prop'] and action['value'] == sub_action['value']:
-        found = True
-        break
-    if not found:
-      return False
+  if actions is None:
+    actions = action_set(node)
+  if sub_actions is None:
+    sub_actions = action_set(sub_node)
   # validation success
-  return True
+  return sub_actions <= actions
 
-# sgf_str should contain the entire sub_sgf_str
+# root should contain the entire game tree under sub_root
 # with only leaf nodes or leaf subtrees added
-def validate_sub_sgf(sgf_str, sub_sgf_str):
-  # helper dfs routine
-  def dfs(root, sub_root):
-    # check if root contains all of sub_root's children
-    for sub_child in sub_root.children:
-      found = False
-      for child in root.children:
-        if validate_sub_node(child, sub_child):
-          found = True
-          # recursively validate the child, subchild pair
-          if not dfs(child, sub_child):
-            return False
+def validate_sub_tree(root, sub_root):
+  # pairs of (node, sub_node) whose children still need to be matched
+  stack = [(root, sub_root)]
+  while stack:
+    node, sub_node = stack.pop()
+    if not sub_node.children:
+      continue
+    # index children by id, keeping sibling order for equal ids
+    children_by_id = {}
+    for child in node.children:
+      children_by_id.setdefault(child.id, []).append(child)
+    # check if node contains all of sub_node's children
+    for sub_child in sub_node.children:
+      sub_actions = action_set(sub_child)
+      match = None
+      for child in children_by_id.get(sub_child.id, ()):
+        if validate_sub_node(child, sub_child, sub_actions=sub_actions):
+          match = child
           break
-      if not found:
+      if match is None:
         return False
-    # validation success
-    return True
+      stack.append((match, sub_child))
+  # validation success
+  return True
 
+# sgf_str should contain the entire sub_sgf_str
+# with only leaf nodes or leaf subtrees added
+# either argument can also be the root of an already parsed game tree
+def validate_sub_sgf(sgf_str, sub_sgf_str):
   # parse both sgf strings
   # if error during parsing, just return false
   sgf = SGF()
   try:
-    root = sgf.parse(sgf_str)
-    sub_root = sgf.parse(sub_sgf_str)
+    root = sgf_str if isinstance(sgf_str, Node) else sgf.parse(sgf_str)
+    sub_root = sub_sgf_str if isinstance(sub_sgf_str, Node) else sgf.parse(sub_sgf_str)
   except Exception as e:
     print(e)
     return False
 
-  return dfs(root, sub_root)
+  return validate_sub_tree(root, sub_root)
+
+# map node id -> node for every node of a game tree
+def index_tree(root):
+  index = {}
+  stack = [root]
+  while stack:
+    node = stack.pop()
+    if node.id != -1:
+      index[node.id] = node
+    stack.extend(node.children)
+  return index
+
+# copy of the game tree at root and its index (see index_tree)
+# the nodes are new, but share their props and values lists, which are
+# never changed once parsed
+def copy_tree(root):
+  index = {}
+  copy_root = None
+  stack = [(root, None)]
+  while stack:
+    node, parent = stack.pop()
+    copy = Node(parent)
+    copy.id = node.id
+    copy.props = node.props
+    copy.values = node.values
+    if parent is None:
+      copy_root = copy
+    else:
+      parent.children.append(copy)
+    if node.id != -1:
+      index[node.id] = copy
+    # pushed in reverse so that children are copied in order
+    stack.extend((child, copy) for child in reversed(node.children))
+  return copy_root, index
+
+# parse one patch operation, which adds the game trees in sgf_str as new
+# children of the node with id parent_id, and return (parent, children)
+# index maps ids to the nodes of the existing tree, and added maps ids to
+# the nodes added by earlier operations of the same patch (updated here)
+# only the new nodes are visited, so the cost does not depend on the size
+# of the existing tree
+# raises ValueError if the operation cannot be applied
+def parse_patch_op(index, added, parent_id, sgf_str, sgf=None):
+  parent = index.get(parent_id)
+  if parent is None:
+    parent = added.get(parent_id)
+  if parent is None:
+    raise ValueError('Unknown parent node: ' + str(parent_id))
+  root = (SGF() if sgf is None else sgf).parse(sgf_str)
+  # the parser only adds ids (starting at the root) if none were given
+  if root.id != -1 or len(root.children) == 0:
+    raise ValueError('Patch nodes must have IDs')
+  new_ids = {}
+  stack = list(root.children)
+  while stack:
+    node = stack.pop()
+    if node.id == -1:
+      raise ValueError('Patch node without ID')
+    if node.id in index or node.id in added or node.id in new_ids:
+      raise ValueError('Duplicate node ID: ' + str(node.id))
+    new_ids[node.id] = node
+    stack.extend(node.children)
+  added.update(new_ids)
+  for child in root.children:
+    child.parent = parent
+  return parent, root.children
+
+# add the parsed operations of a patch to the tree
+def apply_patch(index, added, parsed_ops):
+  for parent, children in parsed_ops:
+    parent.children.extend(children)
+  index.update(added)
+
+# replay patch log operations on a parsed tree
+# operations that no longer apply (e.g. already compacted into the SGF
+# file) are skipped
+def replay_patch(index, ops):
+  for op in ops:
+    added = {}
+    try:
+      parsed = parse_patch_op(index, added, op['parent'], op['sgf'])
+    except (KeyError, TypeError, ValueError):
+      continue
+    apply_patch(index, added, [parsed])
+
+# properties read by get_sgf_info
+SGF_INFO_PROPS = (
+  'PB', # black player
+  'BR', # black rank
+  'PW', # white player
+  'WR', # white rank
+  'KM', # komi
+  'RE' # game result
+)
+
+# find the first non-empty value of every prop in props with a single
+# preorder walk, which stops as soon as all values have been found
+# if header_only is True, nodes below the first node with actions on
+# each line are not visited
+def find_values_by_props(root, props, header_only=False):
+  values = {prop: '' for prop in props}
+  missing = set(props)
+  stack = [root]
+  while stack and missing:
+    node = stack.pop()
+    # only the first action of each prop in a node counts
+    seen = set()
+    for prop, value in node.action_pairs():
+      if prop in missing and prop not in seen:
+        seen.add(prop)
+        if value != '':
+          values[prop] = value
+          missing.discard(prop)
+    if header_only and len(node.props) > 0:
+      continue
+    stack.extend(reversed(node.children))
+
+  return values
 
 # read information stored in SGF file (e.g. player, rank, result)
-# assumes that sgf_str is valid
+# assumes that sgf_str is valid, or is the root of a parsed game tree
 def get_sgf_info(sgf_str):
+  root = sgf_str if isinstance(sgf_str, Node) else SGF().parse(sgf_str)
+  return find_values_by_props(root, SGF_INFO_PROPS)
 
-  # helper function that finds the value of a property
-  def find_value_by_prop(root, prop):
-    value = ''
-
-    # dfs helper
-    def helper(node):
-      nonlocal value
-      for i in range(len(node.actions)):
-        if node.actions[i]['prop'] == prop:
-          value = node.actions[i]['value']
-          break
-      # if value not found, recurse
-      if value == '':
-        for child in node.children:
-          if value == '':
-            helper(child)
-
-    # start from root
-    helper(root)
-    return value
-
-  sgf_info = {
-    'PB': '', # black player
-    'BR': '', # black rank
-    'PW': '', # white player
-    'WR': '', # white rank
-    'KM': '', # komi
-    'RE': '' # game result
-  }
-  
-  root = SGF().parse(sgf_str)
-  for prop in sgf_info:
-    sgf_info[prop] = find_value_by_prop(root, prop)
-
-  return sgf_info
+# parse an uploaded SGF string once and return (valid, info, root)
+# root is None if sgf_str is invalid, and prints to the standardized SGF
+# sgf is the parser to use, whose limit errors are raised instead
+def parse_upload_sgf(sgf_str, sgf=None):
+  try:
+    root = (SGF() if sgf is None else sgf).parse(sgf_str)
+  except SGFLimitError:
+    raise
+  except Exception as e:
+    print(e)
+    return False, None, None
+  return True, get_sgf_info(root), root
 
 # standardize SGF input by parsing and printing
 # assumes that sgf_str is valid
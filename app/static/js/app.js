@@ -1,48 +1,49 @@
-var driver = new Driver(kifu.sgf);
+// the page is shown first, then the SGF is loaded
+var start = function(sgf) {
+  kifu.sgf = sgf;
+  var driver = new Driver(sgf);
 
-if (nodeID) {
-  try {
-    driver.navigateTo(parseInt(nodeID));
-  } catch (e) {
-    console.error(e);
+  if (nodeID) {
+    try {
+      driver.navigateTo(parseInt(nodeID));
+    } catch (e) {
+      console.error(e);
+    }
   }
-}
 
-var bc = new BoardCanvas(
-  document.getElementById('board'),
-  document.getElementById('board').getContext('2d'),
-  driver
-);
+  var bc = new BoardCanvas(
+    document.getElementById('board'),
+    document.getElementById('board').getContext('2d'),
+    driver
+  );
 
-var controller = new Controller(
-  kifu,
-  kifuComments,
-  bc,
-  document.getElementById('control')
-);
+  var controller = new Controller(
+    kifu,
+    commentCounts,
+    bc,
+    document.getElementById('control')
+  );
 
-// if commentID is also available (nodeID must be available too)
-// scroll that comment into view
-if (nodeID && commentID) {
-  try {
-    // find the comment element
-    var commentElements = controller.html.commentList.childNodes;
-    var commentElement = null;
-    for (var i = 0; i < commentElements.length; i++) {
-      if (commentElements[i].getAttribute('comment-id') === commentID) {
-        commentElement = commentElements[i];
-        commentElement.classList.add('highlight');
-        break;
-      }
-    }
-    if (commentElement) {
-      commentElement.scrollIntoView();
-    }
-  } catch (e) {
-    console.error(e);
+  // if commentID is also available (nodeID must be available too)
+  // highlight that comment and scroll it into view once it is loaded
+  if (nodeID && commentID) {
+    controller.commentToHighlight = commentID;
+    controller.updateCommentList();
   }
-}
 
-if (edit === 'True') {
-  controller.html.toggleEdit.click();
-}
+  if (edit === 'True') {
+    controller.html.toggleEdit.click();
+  }
+};
+
+var xhr = new XMLHttpRequest();
+xhr.addEventListener('readystatechange', function() {
+  if (xhr.readyState === 4 && xhr.status === 200) {
+    start(JSON.parse(xhr.responseText).sgf);
+  } else if (xhr.readyState === 4) {
+    window.alert('Network Error: Kifu Not Loaded');
+    throw new exceptions.NetworkError(1, "Kifu SGF Not Loaded");
+  }
+});
+xhr.open('GET', '/kifu/' + kifu.id + '/sgf');
+xhr.send();
@@ -1,7 +1,12 @@
-var Controller = function(kifu, kifuComments, boardCanvas) {
+var Controller = function(kifu, commentCounts, boardCanvas) {
   // retrieve data from server
   this.kifu = kifu;
-  this.kifuComments = kifuComments;
+  // number of comments on each node, and the comments of nodes that have
+  // been loaded so far (comments are loaded the first time a node is shown)
+  this.commentCounts = commentCounts;
+  this.kifuComments = {};
+  this.loadingComments = {};
+  this.commentToHighlight = null;
   this.authStatus = authStatus;
   this.starred = starred;
 
@@ -290,11 +295,25 @@ Controller.prototype.updateCommentList = function() {
   this.html.commentList.innerHTML = '';
   var nodeID = this.boardCanvas.driver.gameTree.currentNode.id;
   var comments = this.kifuComments[nodeID];
+  // comments exist but are not loaded yet
+  if (!comments && this.commentCounts[nodeID]) {
+    this.loadComments(nodeID, null, []);
+    var loading = document.createElement('p');
+    loading.classList.add('no-comment');
+    loading.textContent = 'Loading comments';
+    this.html.commentList.appendChild(loading);
   // if comments exist
-  if (comments) {
+  } else if (comments) {
     var self = this;
     comments.forEach(function(comment) {
-      self.html.commentList.appendChild(self.createCommentElement(comment));
+      var c = self.createCommentElement(comment);
+      self.html.commentList.appendChild(c);
+      // e.g. the comment of a notification
+      if (String(comment.id) === String(self.commentToHighlight)) {
+        c.classList.add('highlight');
+        c.scrollIntoView();
+        self.commentToHighlight = null;
+      }
     });
   // if there are no comments yet
   } else {
@@ -305,6 +324,43 @@ Controller.prototype.updateCommentList = function() {
   }
 };
 
+// load all comments on a node, one page at a time, and show them if the
+// node is still the current one
+Controller.prototype.loadComments = function(nodeID, cursor, loaded) {
+  if (cursor === null) {
+    if (this.loadingComments[nodeID]) {
+      return;
+    }
+    this.loadingComments[nodeID] = true;
+  }
+  var self = this;
+  var xhr = new XMLHttpRequest();
+  xhr.addEventListener('readystatechange', function() {
+    if (xhr.readyState === 4 && xhr.status === 200) {
+      var page = JSON.parse(xhr.responseText);
+      loaded = loaded.concat(page.comments);
+      if (page.next_cursor) {
+        self.loadComments(nodeID, page.next_cursor, loaded);
+        return;
+      }
+      self.kifuComments[nodeID] = loaded;
+      self.loadingComments[nodeID] = false;
+      if (self.boardCanvas.driver.gameTree.currentNode.id === nodeID) {
+        self.updateCommentList();
+      }
+    } else if (xhr.readyState === 4) {
+      self.loadingComments[nodeID] = false;
+      throw new exceptions.NetworkError(1, "Comments Not Loaded");
+    }
+  });
+  var url = '/kifu/' + this.kifu.id + '/comments?node_id=' + nodeID;
+  if (cursor !== null) {
+    url += '&after=' + encodeURIComponent(cursor);
+  }
+  xhr.open('GET', url);
+  xhr.send();
+};
+
 Controller.prototype.initStarAuth = function() {
   // display star/unstar button
   if (this.starred) {
@@ -822,12 +878,14 @@ Controller.prototype.postComment = function(comment) {
     // post successful
     } else if (xhr.readyState === 4 && xhr.status === 200) {
       // add current comment to kifuComments
+      // if the node's comments are not loaded yet, they will include it
       var comment = JSON.parse(xhr.responseText);
-      if (!self.kifuComments[nodeID]) {
+      if (!self.kifuComments[nodeID] && !self.commentCounts[nodeID]) {
         self.kifuComments[nodeID] = [comment];
-      } else {
+      } else if (self.kifuComments[nodeID]) {
         self.kifuComments[nodeID].push(comment);
       }
+      self.commentCounts[nodeID] = (self.commentCounts[nodeID] || 0) + 1;
       // re-enable submit button
       self.html.commentSubmit.disabled = false;
       // clear comment field
@@ -883,8 +941,7 @@ Controller.prototype.updateKifu = function(kifuID, newSGF, deletedNodes) {
   var url = '/kifu/' + kifuID;
   var data = JSON.stringify({
     'sgf': newSGF,
-    'deletedNodes': deletedNodes,
-    'img': createThumbnail(newSGF, config.tq)
+    'deletedNodes': deletedNodes
   });
   xhr.open('UPDATE', url);
   xhr.setRequestHeader('Content-type', 'application/json');
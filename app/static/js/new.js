@@ -10,10 +10,6 @@ newKifu.addEventListener('click', function(e) {
     }
   });
   var url = '/new';
-  var data = JSON.stringify({
-    'img': createThumbnail('()', config.tq)
-  });
   xhr.open('POST', url);
-  xhr.setRequestHeader('Content-type', 'application/json');
-  xhr.send(data);
+  xhr.send();
 });
@@ -3,6 +3,16 @@
 var SGF = (function() {
   var maxNodeID = -1;
 
+  // whether s[i] is escaped by the run of \ before it
+  // (\\ is an escaped \, so \\] ends a value)
+  var isEscaped = function(s, i) {
+    var j = i;
+    while (j > 0 && s[j-1] === '\\') {
+      j--;
+    }
+    return (i - j) % 2 === 1;
+  };
+
   // a helper function that gets index of first ] that is not
   // escaped by a \ before it
   var noEscapeBracketIndex = function(s, start) {
@@ -11,7 +21,7 @@ var SGF = (function() {
       return -1;
     }
 
-    while (nebi !== -1 && s[nebi-1] === '\\') {
+    while (nebi !== -1 && isEscaped(s, nebi)) {
       start = nebi + 1;
       nebi = s.indexOf(']', start);
     }
@@ -12,6 +12,7 @@ var invalidSGFMsg = 'Your file does not contain valid SGF content.';
 var unavailableURLMsg = 'Your URL is invalid or temporarily unavailable.'
 var tooManyMsg = 'Please use only one method to upload your SGF file.';
 var noInputMsg = 'Use one of these three methods to upload your SGF file.';
+var duplicateLinkMsg = 'View it here.';
 var noTitleMsg = 'Kifu title is mandatory.'
 
 
@@ -70,6 +71,18 @@ var postToServer = function(sgfStr) {
     } else if (xhr.readyState === 4 && xhr.status === 400) {
       addInputErrors('#sgf-url-container', invalidSGFMsg);
       upload.disabled = false;
+    // post refused since the same game was uploaded before
+    // the error links to the kifu already uploaded
+    } else if (xhr.readyState === 4 && xhr.status === 409) {
+      var response = JSON.parse(xhr.responseText);
+      addInputErrors('#sgf-url-container', response.message);
+      var errors = document.querySelectorAll('#sgf-url-container .errors li');
+      var link = document.createElement('a');
+      link.href = response.redirect;
+      link.textContent = duplicateLinkMsg;
+      errors[errors.length - 1].appendChild(document.createTextNode(' '));
+      errors[errors.length - 1].appendChild(link);
+      upload.disabled = false;
     // post success
     } else if (xhr.readyState === 4 && xhr.status === 200) {
       window.location.replace(JSON.parse(xhr.responseText).redirect);
@@ -78,7 +91,6 @@ var postToServer = function(sgfStr) {
 
   var data = {
     'sgf': sgfStr,
-    'img': createThumbnail(sgfStr, config.tq),
     'title': titleInput.value,
     'description': descriptionInput.value
   }
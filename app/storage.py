@@ -0,0 +1,163 @@
+import fcntl, gzip, hashlib, json, os, threading, zipfile
+from contextlib import contextmanager
+
+# write data to path through a temporary file renamed into place, so
+# that a half-written file is never read
+def write_atomic(path, data):
+  temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+  try:
+    with open(temp_path, 'wb') as f:
+      f.write(data)
+    os.replace(temp_path, path)
+  finally:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+
+# read an SGF file, either a plain legacy <id>.sgf or a gzipped blob
+def read_sgf_file(path):
+  with open(path, 'rb') as f:
+    data = f.read()
+  if path.endswith(SGFStore.SUFFIX):
+    data = gzip.decompress(data)
+  return data.decode('utf-8')
+
+# gzip data without a timestamp, so equal data compresses to equal bytes
+def gzip_bytes(data, level=9):
+  return gzip.compress(data, level, mtime=0)
+
+# path of a gzipped copy of the file at path, which is (re)built when it
+# is missing or older than the file
+def gzipped_copy(path):
+  gz_path = path + '.gz'
+  gz_stamp = file_stamp(gz_path)
+  if gz_stamp is None or gz_stamp[0] < file_stamp(path)[0]:
+    with open(path, 'rb') as f:
+      write_atomic(gz_path, gzip_bytes(f.read()))
+  return gz_path
+
+# file-like object that a zipfile.ZipFile writes to, which keeps what was
+# written until it is drained, so that an archive can be sent while it is
+# being built (zipfile writes data descriptors as it cannot seek)
+class ZipSink:
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, data):
+    self.chunks.append(bytes(data))
+    return len(data)
+
+  def flush(self):
+    pass
+
+  def drain(self):
+    data = b''.join(self.chunks)
+    self.chunks = []
+    return data
+
+# zip archive of files, an iterable of (name, date_time, data), as chunks of
+# bytes, which are yielded after every file so only one is held at a time
+def iter_zip(files, level=6):
+  sink = ZipSink()
+  with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+    for name, date_time, data in files:
+      info = zipfile.ZipInfo(name, date_time)
+      info.compress_type = zipfile.ZIP_DEFLATED
+      archive.writestr(info, data, compresslevel=level)
+      yield sink.drain()
+  yield sink.drain()
+
+# content-addressed store of SGF files
+# each distinct (standardized) SGF is kept once, gzipped, under the
+# sha256 of its contents, and shared by every kifu with that hash
+# the stored file can be sent as is to clients that accept gzip
+# blobs are immutable, and are only created and removed while holding
+# the lock of their shard (the directory named by the first two hex
+# digits), so that a blob is never removed while it is being reused
+class SGFStore:
+  SUFFIX = '.sgf.z'
+
+  def __init__(self, folder, level):
+    self.folder = folder
+    self.level = level
+
+  @staticmethod
+  def hash(sgf_str):
+    return hashlib.sha256(sgf_str.encode('utf-8')).hexdigest()
+
+  def path(self, sgf_hash):
+    return os.path.join(self.folder, sgf_hash[:2], sgf_hash + self.SUFFIX)
+
+  @contextmanager
+  def locked(self, sgf_hash):
+    shard = os.path.join(self.folder, sgf_hash[:2])
+    os.makedirs(shard, exist_ok=True)
+    with open(os.path.join(shard, '.lock'), 'a') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      yield
+
+  # store sgf_str under its hash unless it is already there, must hold
+  # the lock of the hash
+  def put(self, sgf_hash, sgf_str):
+    path = self.path(sgf_hash)
+    if not os.path.exists(path):
+      write_atomic(path, gzip_bytes(sgf_str.encode('utf-8'), self.level))
+
+  def get(self, sgf_hash):
+    return read_sgf_file(self.path(sgf_hash))
+
+  # the stored gzip bytes
+  def get_gzip(self, sgf_hash):
+    with open(self.path(sgf_hash), 'rb') as f:
+      return f.read()
+
+  # must hold the lock of the hash
+  def remove(self, sgf_hash):
+    try:
+      os.remove(self.path(sgf_hash))
+    except OSError as e:
+      print(e)
+
+# (mtime, size) of a file, or None if it does not exist
+def file_stamp(path):
+  try:
+    st = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return (st.st_mtime_ns, st.st_size)
+
+# patch logs hold the operations applied to a kifu since its SGF file
+# was last written, one JSON object {'parent': id, 'sgf': str} per line
+# writers hold an exclusive lock on the log while they validate, append,
+# and compact, while readers never lock:
+# - compaction stores the new SGF (and commits its hash) before truncating
+#   the log, and readers read the log before the SGF, so operations that
+#   are already in the SGF are skipped on replay, and a reader that raced
+#   with a compaction only misses the latest operations for one request
+# - an operation is only appended as a whole line, and an incomplete
+#   last line is ignored
+@contextmanager
+def locked_patch_log(log_path):
+  # opened for appending, so that truncation by another writer (and not
+  # removal) is the only way the log shrinks, and the lock stays valid
+  with open(log_path, 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    yield f
+
+def append_patch_log(f, ops):
+  f.write(''.join(json.dumps(op) + '\n' for op in ops))
+  f.flush()
+
+# operations in the patch log at log_path, in order
+def read_patch_log(log_path):
+  try:
+    with open(log_path, 'r') as f:
+      data = f.read()
+  except FileNotFoundError:
+    return []
+  ops = []
+  for line in data.split('\n')[:-1]:
+    try:
+      ops.append(json.loads(line))
+    except ValueError as e:
+      print(e)
+  return ops
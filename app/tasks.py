@@ -0,0 +1,39 @@
+import queue, threading
+
+# runs functions one at a time on a background thread, each inside its
+# own application context so that they get their own database session
+class TaskQueue:
+  def __init__(self, app):
+    self.app = app
+    self.__queue = queue.Queue()
+    self.__thread = None
+    self.__lock = threading.Lock()
+
+  def __start(self):
+    with self.__lock:
+      if self.__thread is None:
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+  def __run(self):
+    while True:
+      fn, args = self.__queue.get()
+      try:
+        with self.app.app_context():
+          fn(*args)
+      except Exception as e:
+        print(e)
+      finally:
+        self.__queue.task_done()
+
+  def submit(self, fn, *args):
+    self.__start()
+    self.__queue.put((fn, args))
+
+  # block until every submitted task has run
+  def join(self):
+    self.__queue.join()
+
+  @property
+  def pending(self):
+    return self.__queue.qsize()
@@ -0,0 +1,223 @@
+import hashlib, io, os, threading, time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
+
+from .board import BLACK, WHITE, main_line_position
+from .sgf import SGF
+from .storage import write_atomic
+
+# same palette as static/js/config.js
+COLORS = {
+  'bg': (0xF1, 0xC0, 0x70),
+  'line': (0x62, 0x3F, 0x16),
+  'star': (0x62, 0x3F, 0x16),
+  BLACK: (0x46, 0x46, 0x46),
+  WHITE: (0xF8, 0xF8, 0xF8)
+}
+# stone and star point radius relative to line spacing
+STONE_RADIUS = 0.5
+STAR_RADIUS = 0.1
+# sprites are drawn this many times larger and scaled down for smooth edges
+SUPERSAMPLE = 4
+JPEG_QUALITY = 80
+
+# empty board images and stone sprites, built once per process for
+# each (thumbnail size, board size)
+_sprites = {}
+
+def star_points(board_size):
+  if board_size < 7:
+    return []
+  edge = 3 if board_size >= 13 else 2
+  lines = [edge, board_size - 1 - edge]
+  if board_size % 2 == 1:
+    lines.insert(1, board_size // 2)
+  return [(row, col) for row in lines for col in lines]
+
+def board_sprites(size, board_size):
+  key = (size, board_size)
+  if key in _sprites:
+    return _sprites[key]
+
+  width, height = size
+  # lines are one spacing away from the edges, as on the kifu page
+  spacing = min(width, height) / (board_size + 1)
+  coords = [spacing * (i + 1) for i in range(board_size)]
+
+  # empty board, drawn large and scaled down
+  big = Image.new('RGB', (width * SUPERSAMPLE, height * SUPERSAMPLE), COLORS['bg'])
+  draw = ImageDraw.Draw(big)
+  line_width = max(1, SUPERSAMPLE // 2)
+  first = coords[0] * SUPERSAMPLE
+  last = coords[-1] * SUPERSAMPLE
+  for c in coords:
+    c *= SUPERSAMPLE
+    draw.line([(c, first), (c, last)], fill=COLORS['line'], width=line_width)
+    draw.line([(first, c), (last, c)], fill=COLORS['line'], width=line_width)
+  r = STAR_RADIUS * spacing * SUPERSAMPLE
+  for row, col in star_points(board_size):
+    x = coords[col] * SUPERSAMPLE
+    y = coords[row] * SUPERSAMPLE
+    draw.ellipse([x - r, y - r, x + r, y + r], fill=COLORS['star'])
+  empty = big.resize(size, Image.LANCZOS)
+
+  # stone sprites with an alpha mask
+  diameter = max(1, int(round(2 * STONE_RADIUS * spacing)))
+  stones = {}
+  for color in (BLACK, WHITE):
+    big = Image.new('RGBA', (diameter * SUPERSAMPLE, diameter * SUPERSAMPLE), (0, 0, 0, 0))
+    ImageDraw.Draw(big).ellipse(
+      [0, 0, diameter * SUPERSAMPLE - 1, diameter * SUPERSAMPLE - 1],
+      fill=COLORS[color] + (255,)
+    )
+    stones[color] = big.resize((diameter, diameter), Image.LANCZOS)
+
+  # top left corner of the sprite on each line
+  offsets = [int(round(c - diameter / 2)) for c in coords]
+  _sprites[key] = (empty, stones, offsets)
+  return _sprites[key]
+
+# draw a position (board size and grid of a board.Board) as JPEG bytes
+def draw_position(board_size, grid, size):
+  empty, stones, offsets = board_sprites(size, board_size)
+  img = empty.copy()
+  for i, color in enumerate(grid):
+    if color != 0:
+      row, col = divmod(i, board_size)
+      stone = stones[color]
+      img.paste(stone, (offsets[col], offsets[row]), stone)
+  buf = io.BytesIO()
+  img.save(buf, 'JPEG', quality=JPEG_QUALITY)
+  return buf.getvalue()
+
+# runs in a worker process
+def render_position(board_size, grid, size, path):
+  data = draw_position(board_size, grid, size)
+  write_atomic(path, data)
+  return data
+
+# render the final main line position of sgf_str to path
+# does not need the web app, e.g. for thumbnails of imported kifus
+def render_sgf_thumbnail(sgf_str, size, path):
+  board = main_line_position(SGF().parse(sgf_str))
+  render_position(board.size, bytes(board.grid), size, path)
+
+# key of a position, renders of equal positions are shared
+def position_key(board):
+  return hashlib.sha1(bytes([board.size]) + bytes(board.grid)).hexdigest()
+
+# renders kifu thumbnails from their game trees in a bounded process pool
+# without making the request wait
+# - the main line is replayed in the calling thread (cheap), and nothing
+#   is rendered if its final position did not change since the last render
+# - recent renders are kept by position, so equal positions (e.g. new
+#   kifus, duplicate uploads) are written without drawing again
+# - while a thumbnail is being rendered, newer positions for the same
+#   path replace each other so only the latest one is rendered next
+# with 0 workers, thumbnails are rendered synchronously instead
+class ThumbnailPipeline:
+  def __init__(self, workers, size, cache_size=128):
+    self.workers = workers
+    self.size = size
+    self.cache_size = cache_size
+    self.__executor = None
+    # reentrant, since a done callback runs in the submitting thread
+    # if the render has already finished
+    self.__lock = threading.RLock()
+    # path -> (board size, grid, key) waiting to be rendered
+    self.__pending = {}
+    # path -> future of the render in progress
+    self.__running = {}
+    # paths whose render in progress was cancelled, and whose file is
+    # removed once it is written
+    self.__cancelled = set()
+    # path -> key of the position last written there
+    self.__written = {}
+    # position key -> JPEG bytes, least recently used first
+    self.__renders = OrderedDict()
+
+  # must be called with the lock held
+  def __remember(self, path, key, data):
+    self.__written[path] = key
+    self.__renders[key] = data
+    self.__renders.move_to_end(key)
+    while len(self.__renders) > self.cache_size:
+      self.__renders.popitem(last=False)
+
+  # must be called with the lock held
+  def __start(self, path):
+    if self.__executor is None:
+      self.__executor = ProcessPoolExecutor(max_workers=self.workers)
+    board_size, grid, key = self.__pending.pop(path)
+    future = self.__executor.submit(render_position, board_size, grid, self.size, path)
+    self.__running[path] = future
+    future.add_done_callback(lambda f: self.__done(path, key, f))
+
+  def __done(self, path, key, future):
+    with self.__lock:
+      del self.__running[path]
+      if path in self.__cancelled:
+        self.__cancelled.discard(path)
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        except OSError as e:
+          print(e)
+      elif future.exception() is not None:
+        print(future.exception())
+      else:
+        self.__remember(path, key, future.result())
+      if path in self.__pending:
+        self.__start(path)
+
+  # render the final main line position of the game tree at root to path
+  def submit(self, path, root):
+    board = main_line_position(root)
+    key = position_key(board)
+    with self.__lock:
+      # the path is in use again, e.g. by a new kifu with the id of a
+      # deleted one, and the render below writes after the cancelled one
+      self.__cancelled.discard(path)
+      if path not in self.__running:
+        if self.__written.get(path) == key:
+          return
+        data = self.__renders.get(key)
+        if data is not None:
+          write_atomic(path, data)
+          self.__remember(path, key, data)
+          return
+      if self.workers > 0:
+        self.__pending[path] = (board.size, bytes(board.grid), key)
+        if path not in self.__running:
+          self.__start(path)
+        return
+    data = render_position(board.size, bytes(board.grid), self.size, path)
+    with self.__lock:
+      self.__remember(path, key, data)
+
+  # drop a waiting render, e.g. when its kifu is deleted
+  # a render in progress cannot be stopped, so its file is removed once it
+  # is written
+  def cancel(self, path):
+    with self.__lock:
+      self.__pending.pop(path, None)
+      self.__written.pop(path, None)
+      if path in self.__running:
+        self.__cancelled.add(path)
+
+  # block until no thumbnail is waiting or being rendered
+  def join(self):
+    while True:
+      with self.__lock:
+        futures = list(self.__running.values())
+      if len(futures) == 0:
+        return
+      for future in futures:
+        try:
+          future.result()
+        except Exception:
+          pass
+      # give the done callbacks a chance to run
+      time.sleep(0.01)
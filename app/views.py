@@ -1,33 +1,63 @@
-from flask import render_template, redirect, url_for, flash, request, abort, jsonify, current_app, send_file
+from flask import render_template, redirect, url_for, flash, request, abort, jsonify, current_app, Response, make_response, session, send_file, safe_join, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
-from sqlalchemy.sql import func
-import datetime, os, base64, urllib.request
-from PIL import Image
-
-from . import app, db
-from .models import User, Kifu, Comment, KifuStar, Notification, Rank
+from sqlalchemy.sql import func, and_, or_
+import calendar, datetime, hashlib, mimetypes, os
+
+from . import app, db, password_hasher, sgf_cache, notification_cache, task_queue, thumbnails, sgf_fetcher, search_index
+from .fetch import NetworkError, BusyError, FetchError
+from .passwords import PasswordBusyError
+from .models import User, Kifu, Comment, KifuStar, Notification, Rank, Position, load_authors, load_comment_counts, release_sgf_blob, read_kifu_sgf, index_kifu_positions, search_positions
+from .board import node_position
+from .search import KIFU, COMMENT, KINDS
 from .forms import SignUpForm, LoginForm
-from .sgf import validate_sgf, validate_sub_sgf, get_sgf_info, standardize_sgf
+from .sgf import SGF, SGFLimitError, parse_upload_sgf
+from .storage import SGFStore, gzipped_copy, iter_zip
 
 
 # helper functions to save and retrieve kifu thumbnails
-def save_thumbnail(kifu, base64_str):
-  # first write image to temperory file
-  temp_img = current_app.config['SGF_FOLDER'] + '/.temp' + str(kifu.id)
-  with open(temp_img, 'wb') as f:
-    f.write(base64.decodebytes(bytes(base64_str, 'utf-8')))
-  # write scaled image
-  img = Image.open(temp_img)
-  img.thumbnail(current_app.config['THUMBNAIL_SIZE'])
-  img.save(kifu.imagepath, 'JPEG')
-  # remove temporary file
-  os.remove(temp_img)
+# the final main line position of the game tree at root is drawn by
+# the thumbnail process pool
+def save_thumbnail(kifu, root):
+  thumbnails.submit(kifu.imagepath, root)
 
 def thumbnail_dataurl(kifu):
   with open(kifu.imagepath, 'r') as f:
     # append dataurl prefix
     return 'data:image/jpeg;base64,' + f.read()
 
+# add the notifications triggered by a new comment to the session
+# returns the ids of the receivers, the caller commits
+def add_comment_notifications(comment_id, kifu_id, node_id, author_id, owner_id):
+  receivers = []
+  # first, if the comment is not made by kifu_owner, then
+  # kifu_owner gets a category-1 notification
+  if author_id != owner_id:
+    receivers.append({'category': 1, 'receiver_id': owner_id})
+  # second, other users who have commented on the same node
+  # gets a category-2 notification (excluding the user who
+  # submitted this comment and kifu_owner)
+  other_authors = db.session.query(Comment.author).filter(
+    Comment.kifu_id==kifu_id,
+    Comment.node_id==node_id,
+    Comment.author!=owner_id,
+    Comment.author!=author_id
+  ).distinct()
+  for oa in other_authors:
+    receivers.append({'category': 2, 'receiver_id': oa[0]})
+
+  for r in receivers:
+    r['comment_id'] = comment_id
+    r['read'] = False
+  db.session.bulk_insert_mappings(Notification, receivers)
+  return [r['receiver_id'] for r in receivers]
+
+# background version of add_comment_notifications
+def fan_out_notifications(*args):
+  receiver_ids = add_comment_notifications(*args)
+  db.session.commit()
+  for receiver_id in receiver_ids:
+    notification_cache.invalidate(receiver_id)
+
 # home page
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -36,7 +66,17 @@ def index():
 
   if login_form.login_submit.data and login_form.validate_on_submit():
     user = User.query.filter_by(email=login_form.login_email.data).first()
-    if user is not None and user.verify_password(login_form.login_password.data):
+    try:
+      verified = user is not None and user.verify_password(login_form.login_password.data)
+    except PasswordBusyError as e:
+      flash('Too many people are logging in right now, please try again.')
+      return render_template('index.html', login_form=login_form, sign_up_form=sign_up_form), 503
+    if verified:
+      # rehash passwords hashed with a different BCRYPT_LOG_ROUNDS
+      if password_hasher.needs_rehash(user.password_hash):
+        user.password = login_form.login_password.data
+        db.session.add(user)
+        db.session.commit()
       login_user(user, True)
       return redirect(request.args.get('next') or url_for('index'))
     flash('Invalid email address or password.')
@@ -81,46 +121,57 @@ def post_comment(kifu_id, node_id):
     node_id=node_id
   )
   db.session.add(comment)
-  db.session.commit()
+  Kifu.query.filter_by(id=kifu_id).update({Kifu.comment_count: Kifu.comment_count + 1}, synchronize_session=False)
+  db.session.flush()
+  search_index.index_comment(comment)
 
   # add notifications to database
-  # first, if the comment is not made by kifu_owner, then
-  # kifu_owner gets a category-1 notification
-  if current_user.id != kifu.owner_id:
-    db.session.add(Notification(
-      category=1,
-      receiver_id=kifu.owner_id,
-      comment_id=comment.id
-    ))
-  # second, other users who have commented on the same node
-  # gets a category-2 notification (excluding the user who
-  # submitted this comment and kifu_owner)
-  other_comments = Comment.query.filter_by(
-    kifu_id=kifu_id,
-    node_id=node_id
-  ).all()
-  # generate a filtered list of users who should receive a notification
-  filtered_authors = []
-  for oc in other_comments:
-    duplicate = False
-    for fa in filtered_authors:
-      if oc.author == fa:
-        duplicate = True
-    # filter out duplicate users who commented
-    if not duplicate:
-      # filter out kifu_owner and notification-triggerer
-      if oc.author != kifu.owner_id and oc.author != current_user.id:
-        filtered_authors.append(oc.author)
-  for fa in filtered_authors:
-    db.session.add(Notification(
-      category=2,
-      receiver_id=fa,
-      comment_id=comment.id
-    ))
-  db.session.commit()
+  fan_out_args = (comment.id, kifu_id, node_id, current_user.id, kifu.owner_id)
+  if current_app.config['DEFER_NOTIFICATIONS']:
+    db.session.commit()
+    task_queue.submit(fan_out_notifications, *fan_out_args)
+  else:
+    # comment and notifications are committed together
+    receiver_ids = add_comment_notifications(*fan_out_args)
+    db.session.commit()
+    # receivers' cached unread notifications are now stale
+    for receiver_id in receiver_ids:
+      notification_cache.invalidate(receiver_id)
 
   return jsonify(comment.serialize)
 
+# whether the client's copy is still current, by If-None-Match, or else
+# by If-Modified-Since (last_modified is a naive local datetime)
+def is_not_modified(etag, last_modified=None):
+  if request.if_none_match:
+    return request.if_none_match.contains(etag)
+  if last_modified is not None and request.if_modified_since is not None:
+    since = calendar.timegm(request.if_modified_since.utctimetuple())
+    return int(last_modified.timestamp()) <= since
+  return False
+
+# add validators to a response (or make a 304 response) that clients
+# keep but check again before every use
+def conditional_response(response, etag, last_modified=None, private=False):
+  if response is None:
+    response = Response(status=304)
+  response.set_etag(etag)
+  if last_modified is not None:
+    response.last_modified = int(last_modified.timestamp())
+  response.headers['Cache-Control'] = 'private, no-cache' if private else 'no-cache'
+  return response
+
+# changes whenever a template does, so that pages kept by clients are not
+# reused across deploys
+def templates_version():
+  folder = os.path.join(app.root_path, app.template_folder)
+  return max(
+    os.stat(os.path.join(d, f)).st_mtime_ns
+    for d, _, files in os.walk(folder) for f in files
+  )
+
+TEMPLATES_VERSION = templates_version()
+
 # kifu main page
 @app.route('/kifu/<int:kifu_id>', methods=['GET'])
 def kifu_get(kifu_id):
@@ -133,23 +184,6 @@ def kifu_get(kifu_id):
   # get kifu
   kifu = Kifu.query.filter_by(id=kifu_id).first_or_404()
 
-  # get and process comments for kifu
-  comments = Comment.query.filter_by(kifu_id=kifu_id).all()
-  comments_dict = {}
-
-  # arrange comments by node_id
-  for c in comments:
-    if c.node_id not in comments_dict:
-      comments_dict[c.node_id] = [c]
-    else:
-      comments_dict[c.node_id].append(c)
-
-  # sort comments by timestamp for each node_id
-  for node_id in comments_dict:
-    comments_dict[node_id].sort(key=lambda c: c.timestamp)
-    # serialize comments
-    comments_dict[node_id] = [c.serialize for c in comments_dict[node_id]]
-
   # authentication status
   # 0: not logged in
   # 1: logged in but not owner of kifu
@@ -171,16 +205,146 @@ def kifu_get(kifu_id):
     ).first()
     starred = False if kifustar is None else True
 
-  return render_template(
+  # the page only changes with the kifu (SGF, info, comment and star
+  # counts) and the viewer, so it is not rendered again for a client that
+  # has it already, unless there are flashed messages to show
+  if current_user.is_authenticated:
+    viewer = (
+      current_user.id,
+      starred,
+      current_user.unread_notification_count,
+      tuple(n['id'] for n in current_user.unread_notifications)
+    )
+  else:
+    viewer = None
+  etag = hashlib.sha1(repr((
+    TEMPLATES_VERSION,
+    kifu.sgf_etag,
+    kifu.comment_count,
+    kifu.star_count,
+    viewer,
+    request.query_string
+  )).encode('utf-8')).hexdigest()
+  if '_flashes' not in session and is_not_modified(etag):
+    response = conditional_response(None, etag, private=True)
+    response.vary.add('Cookie')
+    return response
+
+  # the page only carries the number of comments on each node, the SGF
+  # and the comments are loaded from the JSON endpoints below
+  response = make_response(render_template(
     'kifu/kifu.html',
-    kifu=kifu.serialize,
-    kifu_comments=comments_dict,
+    kifu=kifu.to_dict(with_sgf=False),
+    comment_counts=load_comment_counts(kifu_id),
     auth_status=auth_status,
     starred=starred,
     node_id=query_node_id,
     edit=query_edit,
     comment_id=query_comment_id,
     url=url_for('kifu_get', kifu_id=kifu_id, _external=True)
+  ))
+  response.vary.add('Cookie')
+  return conditional_response(response, etag, private=True)
+
+# SGF of a kifu as JSON
+@app.route('/kifu/<int:kifu_id>/sgf', methods=['GET'])
+def kifu_sgf(kifu_id):
+  kifu = Kifu.query.filter_by(id=kifu_id).first_or_404()
+  etag = kifu.sgf_etag + '-json'
+  if is_not_modified(etag, kifu.last_modified):
+    response = None
+  else:
+    response = jsonify({'id': kifu.id, 'sgf': kifu.sgf})
+  return conditional_response(response, etag, kifu.last_modified)
+
+# comment cursors are the node id, timestamp and id of the last comment
+# of a page, joined by underscores
+def encode_comment_cursor(comment):
+  return '%d_%s_%d' % (
+    comment.node_id,
+    comment.timestamp.strftime(CURSOR_TIME_FORMAT),
+    comment.id
+  )
+
+def decode_comment_cursor(cursor):
+  try:
+    node_id, timestamp, comment_id = cursor.split('_')
+    timestamp = datetime.datetime.strptime(timestamp, CURSOR_TIME_FORMAT)
+    return int(node_id), timestamp, int(comment_id)
+  except ValueError:
+    abort(400)
+
+# comments of a kifu as JSON, in (node id, timestamp) order
+# either of one node (node_id=N) or of a range of node ids (from_node=A
+# and/or to_node=B, inclusive), per_page at a time, and the next page is
+# requested with after=next_cursor
+# comments are never edited, so the comment count of the kifu tells
+# whether the client's copy is still current
+@app.route('/kifu/<int:kifu_id>/comments', methods=['GET'])
+def kifu_comments(kifu_id):
+  kifu = Kifu.query.filter_by(id=kifu_id).first_or_404()
+  etag = 'comments-%d' % kifu.comment_count
+  if is_not_modified(etag):
+    return conditional_response(None, etag)
+
+  node_id = request.args.get('node_id', type=int)
+  from_node = request.args.get('from_node', type=int)
+  to_node = request.args.get('to_node', type=int)
+  per_page = request.args.get('per_page', current_app.config['NODE_COMMENT_PERPAGE'], type=int)
+  per_page = max(1, min(per_page, current_app.config['NODE_COMMENT_PERPAGE']))
+  after = request.args.get('after')
+
+  comment_query = Comment.query.filter(Comment.kifu_id == kifu_id)
+  if node_id is not None:
+    comment_query = comment_query.filter(Comment.node_id == node_id)
+  else:
+    if from_node is not None:
+      comment_query = comment_query.filter(Comment.node_id >= from_node)
+    if to_node is not None:
+      comment_query = comment_query.filter(Comment.node_id <= to_node)
+  if after is not None:
+    after_node, after_time, after_id = decode_comment_cursor(after)
+    comment_query = comment_query.filter(or_(
+      Comment.node_id > after_node,
+      and_(Comment.node_id == after_node, or_(
+        Comment.timestamp > after_time,
+        and_(Comment.timestamp == after_time, Comment.id > after_id)
+      ))
+    ))
+  # one extra comment tells whether there is a next page
+  comments = comment_query.order_by(
+    Comment.node_id, Comment.timestamp, Comment.id
+  ).limit(per_page + 1).all()
+  has_next = len(comments) > per_page
+  comments = comments[:per_page]
+
+  authors = load_authors([c.author for c in comments])
+  response = jsonify({
+    'comments': [c.to_dict(authors) for c in comments],
+    'next_cursor': encode_comment_cursor(comments[-1]) if has_next else None
+  })
+  return conditional_response(response, etag)
+
+# number of comments on each node of a kifu that has comments, as JSON
+@app.route('/kifu/<int:kifu_id>/comment-counts', methods=['GET'])
+def kifu_comment_counts(kifu_id):
+  kifu = Kifu.query.filter_by(id=kifu_id).first_or_404()
+  etag = 'comment-counts-%d' % kifu.comment_count
+  if is_not_modified(etag):
+    response = None
+  else:
+    response = jsonify({'counts': load_comment_counts(kifu_id)})
+  return conditional_response(response, etag)
+
+# parser for SGF sent by clients, which rejects SGF over the configured
+# limits (with 413) before it is parsed as a whole
+def client_sgf_parser():
+  config = current_app.config
+  return SGF(
+    max_bytes=config['SGF_MAX_BYTES'],
+    max_nodes=config['SGF_MAX_NODES'],
+    max_depth=config['SGF_MAX_DEPTH'],
+    max_value_length=config['SGF_MAX_VALUE_LENGTH']
   )
 
 # update kifu
@@ -193,12 +357,20 @@ def kifu_update(kifu_id):
   kifu.modified_on = datetime.datetime.now()
 
   # update SGF
-  if 'sgf' in data: # deletedNodes and img should also be present
-    # first ensure that new SGF contains all nodes present in the old SGF
-    if not validate_sub_sgf(data['sgf'], kifu.sgf):
+  if 'sgf' in data: # deletedNodes should also be present
+    try:
+      root = client_sgf_parser().parse(data['sgf'])
+    except SGFLimitError as e:
+      abort(413)
+    except Exception as e:
       abort(401)
-    # update SGF
-    kifu.update_sgf(data['sgf'])
+    # update SGF, ensuring that the new SGF contains all nodes present in
+    # the old SGF
+    try:
+      kifu.update_sgf(root, validate=True)
+    except ValueError as e:
+      abort(401)
+    index_kifu_positions(kifu.id, root)
 
     ### disable comment deletion because as of now, nobody is allowed
     ### to delete existing nodes in a kifu
@@ -212,7 +384,7 @@ def kifu_update(kifu_id):
     #     db.session.delete(c)
 
     # update kifu thumbnail
-    save_thumbnail(kifu, data['img'])
+    save_thumbnail(kifu, root)
   
   # update other data (must be kifu owner)
   if current_user.id == kifu.owner_id:
@@ -232,11 +404,47 @@ def kifu_update(kifu_id):
       kifu.description = data['description']
     if 'title' in data:
       kifu.title = data['title']
+    search_index.index_kifu(kifu)
 
   db.session.add(kifu)
   db.session.commit()
   return jsonify(kifu.serialize)
 
+# add nodes to a kifu without sending the whole SGF
+# the body is {'ops': [{'parent': node id, 'sgf': SGF string}, ...]},
+# where every node in the SGF strings has a new ID
+@app.route('/kifu/<int:kifu_id>', methods=['PATCH'])
+@login_required
+def kifu_patch(kifu_id):
+  kifu = Kifu.query.filter_by(id=kifu_id).first_or_404()
+
+  data = request.get_json()
+  ops = data.get('ops') if isinstance(data, dict) else None
+  if not isinstance(ops, list) or len(ops) == 0:
+    abort(400)
+  for op in ops:
+    if not isinstance(op, dict) or type(op.get('parent')) is not int \
+      or not isinstance(op.get('sgf'), str):
+      abort(400)
+
+  try:
+    root = kifu.patch_sgf(
+      [{'parent': op['parent'], 'sgf': op['sgf']} for op in ops],
+      client_sgf_parser()
+    )
+  except SGFLimitError as e:
+    print(e)
+    abort(413)
+  except Exception as e:
+    print(e)
+    abort(401)
+
+  kifu.modified_on = datetime.datetime.now()
+  save_thumbnail(kifu, root)
+  db.session.add(kifu)
+  db.session.commit()
+  return jsonify({'success': True})
+
 # delete kifu
 @app.route('/kifu/<int:kifu_id>', methods=['DELETE'])
 @login_required
@@ -245,32 +453,45 @@ def kifu_delete(kifu_id):
   if (kifu.owner_id != current_user.id):
     abort(401)
 
-  # delete all notifications triggered by comments on this kifu
-  kifu_comments = Comment.query.filter_by(kifu_id=kifu_id).all()
-  for kc in kifu_comments:
-    kifu_notifications = Notification.query.filter_by(comment_id=kc.id).all()
-    for kn in kifu_notifications:
-      db.session.delete(kn)
-  db.session.commit()
+  # everything is deleted with set-based statements in one transaction
+  comment_ids = db.session.query(Comment.id).filter(Comment.kifu_id==kifu_id)
+  notifications = Notification.query.filter(Notification.comment_id.in_(comment_ids.subquery()))
+  # users whose cached unread notifications will become stale
+  receiver_ids = [r[0] for r in notifications.with_entities(Notification.receiver_id).distinct()]
 
+  # delete all notifications triggered by comments on this kifu
+  notifications.delete(synchronize_session=False)
+  # remove this kifu and its comments from the search index
+  search_index.remove_kifu(kifu_id)
   # delete all comments posted on this kifu
-  for kc in kifu_comments:
-    db.session.delete(kc)
-  db.session.commit()
-
+  Comment.query.filter_by(kifu_id=kifu_id).delete(synchronize_session=False)
   # delete all kifustars entries of this kifu
-  stars = KifuStar.query.filter_by(kifu_id=kifu_id)
-  for s in stars:
-    db.session.delete(s)
-  db.session.commit()
-
+  KifuStar.query.filter_by(kifu_id=kifu_id).delete(synchronize_session=False)
+  # delete the positions reached in this kifu
+  Position.query.filter_by(kifu_id=kifu_id).delete(synchronize_session=False)
   # delete kifu and commit
+  sgf_hash = kifu.sgf_hash
   db.session.delete(kifu)
   db.session.commit()
 
-  # remove local file
-  os.remove(kifu.filepath)
-  os.remove(kifu.imagepath)
+  for receiver_id in receiver_ids:
+    notification_cache.invalidate(receiver_id)
+
+  # remove local files only after the commit succeeded
+  # a file that fails to be removed is just left behind
+  sgf_cache.invalidate(kifu.id)
+  thumbnails.cancel(kifu.imagepath)
+  paths = [kifu.logpath, kifu.imagepath]
+  # the stored SGF may still be shared with other kifus
+  if sgf_hash is None:
+    paths.append(kifu.legacy_filepath)
+  else:
+    release_sgf_blob(sgf_hash)
+  for path in paths:
+    try:
+      os.remove(path)
+    except OSError as e:
+      print(e)
 
   return jsonify({
     'redirect': url_for('index', _external=True)
@@ -289,10 +510,28 @@ def upload():
   # validate SGF and get SGF info
   kifu_json = request.get_json()
   print(kifu_json)
-  if not validate_sgf(kifu_json['sgf']):
+  try:
+    valid, info, root = parse_upload_sgf(kifu_json['sgf'], client_sgf_parser())
+  except SGFLimitError as e:
+    print(e)
+    abort(413)
+  if not valid:
     abort(400)
-  info = get_sgf_info(kifu_json['sgf'])
-  sgf_str = standardize_sgf(kifu_json['sgf'])
+
+  # the same game is only uploaded once per user, the upload is refused
+  # (and its title and description are not used) with a link to the kifu
+  # already uploaded
+  sgf_str = SGF().print(root)
+  duplicate = Kifu.query.filter_by(
+    sgf_hash=SGFStore.hash(sgf_str),
+    owner_id=current_user.id
+  ).first()
+  if duplicate is not None:
+    return jsonify({
+      'message': 'You have already uploaded this game.',
+      'redirect': url_for('kifu_get', kifu_id=duplicate.id, _external=True),
+      'duplicate': True
+    }), 409
 
   # insert kifu into database
   kifu = Kifu(
@@ -310,12 +549,14 @@ def upload():
   db.session.add(kifu)
   db.session.commit()
 
-  # write SGF to file
-  with open(kifu.filepath, 'w') as f:
-    f.write(sgf_str)
+  # store standardized SGF, shared with identical uploads
+  kifu.update_sgf(sgf_str)
+  index_kifu_positions(kifu.id, root)
+  search_index.index_kifu(kifu)
+  db.session.commit()
 
   # save kifu thumbnail
-  save_thumbnail(kifu, kifu_json['img'])
+  save_thumbnail(kifu, root)
 
   return jsonify({
     'redirect': url_for('kifu_get', kifu_id=kifu.id, _external=True)
@@ -324,16 +565,17 @@ def upload():
 @app.route('/get-external-sgf', methods=['POST'])
 def get_external_sgf():
   url = request.get_json()['url']
-  # catch network/invalid url errors
   try:
-    response = urllib.request.urlopen(url, timeout=current_app.config['URL_TIMEOUT'])
-  except Exception as e:
+    sgf_str = sgf_fetcher.fetch(url)
+  # catch network/invalid url errors
+  except NetworkError as e:
     abort(404)
-  # catch invalid text file errors
-  try:
-    return jsonify({'sgf': response.read().decode('utf-8')})
-  except Exception as e:
+  except BusyError as e:
+    abort(503)
+  # catch too large or invalid text file errors
+  except FetchError as e:
     abort(400)
+  return jsonify({'sgf': sgf_str})
 
 # create a new, empty kifu
 @app.route('/new', methods=['GET'])
@@ -353,12 +595,11 @@ def new():
   db.session.commit()
 
   # write empty SGF to file
-  with open(kifu.filepath, 'w') as f:
-    f.write(standardize_sgf('()'))
+  root = SGF().parse('()')
+  kifu.update_sgf(root)
 
   # save kifu thumbnail
-  with open(current_app.config['EMPTY_BOARD_DATAURL'], 'r') as f:
-    save_thumbnail(kifu, f.read())
+  save_thumbnail(kifu, root)
 
   return redirect(url_for('kifu_get', kifu_id=kifu.id, edit=True))
 
@@ -382,6 +623,7 @@ def star_kifu(kifu_id):
     kifu_id=kifu_id
   )
   db.session.add(kifustar)
+  Kifu.query.filter_by(id=kifu_id).update({Kifu.star_count: Kifu.star_count + 1}, synchronize_session=False)
   db.session.commit()
 
   return jsonify({'success': True})
@@ -402,6 +644,7 @@ def unstar_kifu(kifu_id):
 
   # unstar kifu
   db.session.delete(starred)
+  Kifu.query.filter_by(id=kifu_id).update({Kifu.star_count: Kifu.star_count - 1}, synchronize_session=False)
   db.session.commit()
 
   return jsonify({'success': True})
@@ -410,16 +653,58 @@ def unstar_kifu(kifu_id):
 @app.route('/download/<int:kifu_id>', methods=['GET'])
 def download(kifu_id):
   kifu = Kifu.query.filter_by(id=kifu_id).first_or_404()
-  return send_file(
-    kifu.filepath,
-    mimetype='text/sgf',
-    attachment_filename=str(kifu.id)+'.sgf',
-    as_attachment=True
-  )
+  # validators come from the kifu row, so an unchanged SGF is not read
+  # the stored SGF is already gzipped, and is sent as is when accepted
+  use_gzip = request.accept_encodings['gzip'] > 0
+  etag = kifu.sgf_etag + ('-gzip' if use_gzip else '')
+  if is_not_modified(etag, kifu.last_modified):
+    response = None
+  elif use_gzip:
+    response = Response(kifu.sgf_gzip, mimetype='text/sgf')
+    response.headers['Content-Encoding'] = 'gzip'
+  else:
+    response = Response(kifu.sgf, mimetype='text/sgf')
+  response = conditional_response(response, etag, kifu.last_modified)
+  response.headers['Content-Disposition'] = 'attachment; filename=%d.sgf' % kifu.id
+  response.vary.add('Accept-Encoding')
+  return response
+
+# cursors mark the position of a kifu in a sorted kifu list, as the
+# sorted value and the kifu id joined by an underscore
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def encode_kifu_cursor(kifu, sort_by):
+  if sort_by == 'date':
+    value = kifu.uploaded_on.strftime(CURSOR_TIME_FORMAT)
+  else:
+    value = str(kifu.comment_count)
+  return value + '_' + str(kifu.id)
+
+def decode_kifu_cursor(cursor, sort_by):
+  try:
+    value, kifu_id = cursor.rsplit('_', 1)
+    if sort_by == 'date':
+      value = datetime.datetime.strptime(value, CURSOR_TIME_FORMAT)
+    else:
+      value = int(value)
+    return value, int(kifu_id)
+  except ValueError:
+    abort(400)
+
+# kifus of kifu_query uploaded by or saved by a user, if either is given
+def filter_kifus_by_user(kifu_query, uploaded_by=None, saved_by=None):
+  if uploaded_by is not None:
+    kifu_query = kifu_query.filter(Kifu.owner_id == uploaded_by)
+  elif saved_by is not None:
+    saved_kifu_ids = db.session.query(KifuStar.kifu_id).filter(KifuStar.user_id==saved_by)
+    kifu_query = kifu_query.filter(Kifu.id.in_(saved_kifu_ids.subquery()))
+  return kifu_query
 
 # helper function that generates a kifu pagination
 # based on constraints of its arguments
-def get_kifu_pagination(page, sort_by, time_frame, display_in, uploaded_by=None, saved_by=None):
+# pages are fetched by keyset (after/before the kifu at a cursor) instead
+# of OFFSET, which is only used for links without a cursor
+def get_kifu_pagination(page, sort_by, time_frame, display_in, after=None, before=None, uploaded_by=None, saved_by=None):
   # kifus uploaded after earliest_time will be included
   current_time = datetime.datetime.now()
   if time_frame == 'day':
@@ -433,43 +718,54 @@ def get_kifu_pagination(page, sort_by, time_frame, display_in, uploaded_by=None,
   else:
     earliest_time = None
 
-  # subquery to count number of comments each kifu has
-  count_query = db.session.query(Comment.kifu_id, func.count('*').label('comment_count')).group_by(Comment.kifu_id).subquery()
-
   # query to get all the kifu info
-  kifu_query = db.session.query(Kifu, User, count_query.c.comment_count).join(User).outerjoin(count_query, Kifu.id==count_query.c.kifu_id)
+  kifu_query = db.session.query(Kifu, User).join(User, Kifu.owner_id==User.id)
 
   # filter query if uploaded_by or save_by is specified
-  if uploaded_by is not None:
-    kifu_query = kifu_query.filter(Kifu.owner_id == uploaded_by)
-  elif saved_by is not None:
-    saved_kifu_ids = [sk_id[0] for sk_id in db.session.query(KifuStar.kifu_id).filter(KifuStar.user_id==saved_by).distinct()]
-    # print(saved_kifu_ids)
-    kifu_query = kifu_query.filter(Kifu.id.in_(saved_kifu_ids))
+  kifu_query = filter_kifus_by_user(kifu_query, uploaded_by, saved_by)
 
   # filter query by upload date
   if earliest_time is not None:
     kifu_query = kifu_query.filter(Kifu.uploaded_on >= earliest_time)
 
-  # order query based on query strings
-  if sort_by == 'date':
-    if display_in == 'desc':
-      sorted_query = kifu_query.order_by(Kifu.uploaded_on.desc())
+  # order query based on query strings, with kifu id breaking ties
+  sort_column = Kifu.uploaded_on if sort_by == 'date' else Kifu.comment_count
+  # the previous page is fetched by walking the list backwards
+  backwards = before is not None
+  cursor = before if backwards else after
+  descending = (display_in == 'desc') != backwards
+
+  if cursor is not None:
+    value, kifu_id = decode_kifu_cursor(cursor, sort_by)
+    if descending:
+      kifu_query = kifu_query.filter(or_(sort_column < value, and_(sort_column == value, Kifu.id < kifu_id)))
     else:
-      sorted_query = kifu_query.order_by(Kifu.uploaded_on.asc())
+      kifu_query = kifu_query.filter(or_(sort_column > value, and_(sort_column == value, Kifu.id > kifu_id)))
+  if descending:
+    kifu_query = kifu_query.order_by(sort_column.desc(), Kifu.id.desc())
   else:
-    if display_in == 'desc':
-      sorted_query = kifu_query.order_by(count_query.c.comment_count.desc())
-    else:
-      sorted_query = kifu_query.order_by(count_query.c.comment_count.asc())
-
-  # paginate
-  sorted_pagination = sorted_query.paginate(
-    page=page,
-    per_page=current_app.config['KIFU_PERPAGE'],
-    error_out=True
-  )
-  return sorted_pagination
+    kifu_query = kifu_query.order_by(sort_column.asc(), Kifu.id.asc())
+
+  per_page = current_app.config['KIFU_PERPAGE']
+  if cursor is None and page > 1:
+    kifu_query = kifu_query.offset((page-1) * per_page)
+  # fetch one extra kifu to know if there are more
+  items = kifu_query.limit(per_page + 1).all()
+  has_more = len(items) > per_page
+  items = items[:per_page]
+
+  if backwards:
+    items.reverse()
+    has_prev, has_next = has_more, True
+  else:
+    has_prev, has_next = page > 1, has_more
+  return {
+    'items': items,
+    'has_prev': has_prev and len(items) > 0,
+    'has_next': has_next and len(items) > 0,
+    'prev_cursor': encode_kifu_cursor(items[0][0], sort_by) if items else None,
+    'next_cursor': encode_kifu_cursor(items[-1][0], sort_by) if items else None
+  }
 
 # browse kifu
 @app.route('/browse', methods=['GET'])
@@ -481,33 +777,194 @@ def browse_kifu(upload_user_id=None, save_user_id=None):
   sort_by = request.args.get('sort-by') if request.args.get('sort-by') else 'date'
   time_frame = request.args.get('time-frame') if request.args.get('time-frame') else 'all-time'
   display_in = request.args.get('display-in') if request.args.get('display-in') else 'desc'
+  after = request.args.get('after')
+  before = request.args.get('before')
 
   if upload_user_id is not None:
     user = User.query.filter_by(id=upload_user_id).first_or_404()
-    kifu_pagination = get_kifu_pagination(page, sort_by, time_frame, display_in, uploaded_by=upload_user_id)
+    kifu_pagination = get_kifu_pagination(page, sort_by, time_frame, display_in, after, before, uploaded_by=upload_user_id)
     base_url = '/browse/user-upload/' + str(upload_user_id)
+    export_url = url_for('export_kifus', upload_user_id=upload_user_id)
     browse_title = 'Uploads by %s (%s)' % (user.username, user.rank)
   elif save_user_id is not None:
     user = User.query.filter_by(id=save_user_id).first_or_404()
-    kifu_pagination = get_kifu_pagination(page, sort_by, time_frame, display_in, saved_by=save_user_id)
+    kifu_pagination = get_kifu_pagination(page, sort_by, time_frame, display_in, after, before, saved_by=save_user_id)
     base_url = '/browse/user-save/' + str(save_user_id)
+    export_url = url_for('export_kifus', save_user_id=save_user_id)
     browse_title = 'Kifus saved by %s (%s)' % (user.username, user.rank)
   else:
-    kifu_pagination = get_kifu_pagination(page, sort_by, time_frame, display_in)
+    kifu_pagination = get_kifu_pagination(page, sort_by, time_frame, display_in, after, before)
     base_url = '/browse'
+    export_url = None
     browse_title = 'All uploads on Kifutalk'
 
   return render_template(
     'browse.html',
     base_url=base_url,
     browse_title=browse_title,
-    items=kifu_pagination.items,
-    page_num=kifu_pagination.page,
-    has_next=kifu_pagination.has_next,
-    has_prev=kifu_pagination.has_prev,
+    export_url=export_url,
+    items=kifu_pagination['items'],
+    page_num=page,
+    has_next=kifu_pagination['has_next'],
+    has_prev=kifu_pagination['has_prev'],
+    prev_url=base_url + '?page=%d&before=%s' % (page-1, kifu_pagination['prev_cursor']),
+    next_url=base_url + '?page=%d&after=%s' % (page+1, kifu_pagination['next_cursor']),
     query_string_list=[sort_by, time_frame, display_in]
   )
 
+# files of an export archive, read one at a time from the rows of
+# export_kifus
+def export_files(rows):
+  for kifu_id, sgf_hash, last_modified in rows:
+    try:
+      sgf_str = read_kifu_sgf(kifu_id, sgf_hash)
+    except FileNotFoundError:
+      # the kifu was stored again or deleted after the query
+      row = db.session.query(Kifu.sgf_hash).filter(Kifu.id == kifu_id).first()
+      try:
+        if row is None:
+          continue
+        sgf_str = read_kifu_sgf(kifu_id, row[0])
+      except FileNotFoundError as e:
+        print(e)
+        continue
+    yield '%d.sgf' % kifu_id, last_modified.timetuple()[:6], sgf_str.encode('utf-8')
+
+# download all kifus uploaded or saved by a user as one zip archive
+# the archive is streamed while the SGF files are read, so neither the
+# archive nor all the SGF files are ever held at once
+@app.route('/export/user-upload/<int:upload_user_id>', methods=['GET'])
+@app.route('/export/user-save/<int:save_user_id>', methods=['GET'])
+def export_kifus(upload_user_id=None, save_user_id=None):
+  user = User.query.filter_by(id=upload_user_id or save_user_id).first_or_404()
+  # ids, hashes and dates of all the kifus in one query
+  kifu_query = db.session.query(
+    Kifu.id,
+    Kifu.sgf_hash,
+    func.coalesce(Kifu.modified_on, Kifu.uploaded_on)
+  )
+  kifu_query = filter_kifus_by_user(kifu_query, upload_user_id, save_user_id)
+  rows = kifu_query.order_by(Kifu.id).all()
+
+  filename = '%s-%s.zip' % (
+    user.username,
+    'uploads' if upload_user_id is not None else 'saved'
+  )
+  response = Response(
+    stream_with_context(iter_zip(export_files(rows))),
+    mimetype='application/zip'
+  )
+  response.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+  return response
+
+# kifus that reached a position, given as a node of a kifu (kifu_id and
+# node_id, that kifu is left out) or as a hash (see board.py)
+# with symmetric=1 (the default), rotated and mirrored positions match too
+# results are by kifu id, continued with after=<next from the last page>
+# hashes are sent as strings, as they do not fit in a JavaScript number
+@app.route('/search/position', methods=['GET'])
+def search_position():
+  symmetric = request.args.get('symmetric', '1') == '1'
+  try:
+    after = int(request.args.get('after', 0))
+    if 'hash' in request.args:
+      h = int(request.args['hash'])
+      kifu_id = None
+    else:
+      kifu_id = int(request.args['kifu_id'])
+      node_id = int(request.args['node_id'])
+  except (KeyError, ValueError):
+    abort(400)
+
+  if kifu_id is not None:
+    kifu = Kifu.query.filter_by(id=kifu_id).first_or_404()
+    root, index = kifu.sgf_index
+    if node_id not in index:
+      abort(404)
+    board = node_position(index[node_id], symmetric)
+    h = board.normalized_hash if symmetric else board.hash
+
+  per_page = current_app.config['POSITION_SEARCH_PERPAGE']
+  results = search_positions(h, symmetric, after, per_page + 1, kifu_id)
+  has_next = len(results) > per_page
+  results = results[:per_page]
+
+  kifus = {k.id: k for k in Kifu.query.filter(Kifu.id.in_([r[0] for r in results]))}
+  authors = load_authors(set(k.owner_id for k in kifus.values()))
+  items = []
+  for result_kifu_id, result_node_id in results:
+    if result_kifu_id not in kifus:
+      continue
+    item = kifus[result_kifu_id].to_dict(authors, with_sgf=False)
+    item['node_id'] = result_node_id
+    item['url'] = url_for('kifu_get', kifu_id=result_kifu_id, node_id=result_node_id, _external=True)
+    items.append(item)
+  return jsonify({
+    'hash': str(h),
+    'symmetric': symmetric,
+    'kifus': items,
+    'next': str(results[-1][0]) if has_next else None
+  })
+
+# full-text search of kifus (title, players and description) and comments
+# q is the text to search for, type is 'kifu' or 'comment' (both if not
+# given), and results are ranked best first
+@app.route('/search', methods=['GET'])
+def search():
+  query = request.args.get('q', '')
+  kind = request.args.get('type')
+  try:
+    page = int(request.args.get('page', 1))
+  except ValueError:
+    abort(400)
+  if page < 1 or (kind is not None and kind not in KINDS):
+    abort(400)
+
+  per_page = current_app.config['SEARCH_PERPAGE']
+  results = search_index.search(query, kind, (page-1) * per_page, per_page + 1)
+  has_next = len(results) > per_page
+  results = results[:per_page]
+
+  # matches are loaded with one query per kind
+  kifu_ids = [ref_id for k, ref_id in results if k == KIFU]
+  comment_ids = [ref_id for k, ref_id in results if k == COMMENT]
+  kifus = {k.id: k for k in Kifu.query.filter(Kifu.id.in_(kifu_ids))} if kifu_ids else {}
+  comments = {}
+  if comment_ids:
+    rows = db.session.query(Comment, Kifu.title).join(Kifu, Comment.kifu_id==Kifu.id) \
+      .filter(Comment.id.in_(comment_ids))
+    comments = {c.id: (c, title) for c, title in rows}
+  authors = load_authors(
+    [k.owner_id for k in kifus.values()] + [c.author for c, title in comments.values()]
+  )
+
+  items = []
+  for k, ref_id in results:
+    if k == KIFU and ref_id in kifus:
+      item = kifus[ref_id].to_dict(authors, with_sgf=False)
+      item['type'] = 'kifu'
+      item['url'] = url_for('kifu_get', kifu_id=ref_id, _external=True)
+    elif k == COMMENT and ref_id in comments:
+      comment, title = comments[ref_id]
+      item = comment.to_dict(authors)
+      item['type'] = 'comment'
+      item['kifu_title'] = title
+      item['url'] = url_for(
+        'kifu_get',
+        kifu_id=comment.kifu_id,
+        node_id=comment.node_id,
+        comment_id=comment.id,
+        _external=True
+      )
+    else:
+      continue
+    items.append(item)
+  return jsonify({
+    'results': items,
+    'page': page,
+    'has_next': has_next
+  })
+
 @app.route('/comments/user/<int:user_id>', methods=['GET'])
 def browse_comment(user_id):
   page = int(request.args.get('page')) if request.args.get('page') else 1
@@ -534,4 +991,25 @@ def read_notification(notification_id):
   notification.read = True
   db.session.add(notification)
   db.session.commit()
+  notification_cache.invalidate(notification.receiver_id)
   return jsonify({'success': True})
+
+# static JS and CSS are sent from gzipped copies, built on first use, to
+# clients that accept gzip
+def static_file(filename):
+  if filename.endswith(('.js', '.css')) and request.accept_encodings['gzip'] > 0:
+    path = safe_join(app.static_folder, filename)
+    if os.path.isfile(path):
+      response = send_file(
+        gzipped_copy(path),
+        mimetype=mimetypes.guess_type(filename)[0],
+        conditional=True
+      )
+      response.headers['Content-Encoding'] = 'gzip'
+      response.vary.add('Accept-Encoding')
+      return response
+  response = app.send_static_file(filename)
+  response.vary.add('Accept-Encoding')
+  return response
+
+app.view_functions['static'] = static_file
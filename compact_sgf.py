@@ -0,0 +1,29 @@
+import os, time
+
+from app import app
+from app.models import Kifu
+
+# write the patched SGF of every kifu with a non-empty patch log as a new
+# stored SGF and empty the log, so that downloads send the stored gzipped
+# file again (patches are otherwise only compacted once the log grows
+# past SGF_PATCH_LOG_MAX bytes)
+with app.app_context():
+  folder = app.config['SGF_FOLDER']
+  kifu_ids = []
+  for filename in os.listdir(folder):
+    name, ext = os.path.splitext(filename)
+    if ext == '.log' and name.endswith('.sgf') and name[:-4].isdigit() \
+      and os.path.getsize(os.path.join(folder, filename)) > 0:
+      kifu_ids.append(int(name[:-4]))
+  start = time.time()
+  compacted = 0
+  for kifu_id in sorted(kifu_ids):
+    kifu = Kifu.query.get(kifu_id)
+    if kifu is None:
+      continue
+    try:
+      kifu.compact_sgf()
+      compacted += 1
+    except Exception as e:
+      print(kifu_id, e)
+  print('%d kifus compacted in %.1f s' % (compacted, time.time() - start))
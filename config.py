@@ -1,10 +1,31 @@
 DEBUG = True
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 BCRYPT_LOG_ROUNDS = 15
+PASSWORD_WORKERS = 2 # 0 hashes passwords in the request
+PASSWORD_MAX_PENDING = 16 # logins waiting for a worker before refusing more
 SGF_FOLDER = '/home/guyu/kifutalk/app/static/assets/sgf'
 THUMBNAIL_FOLDER = '/home/guyu/kifutalk/app/static/assets/thumbnail'
-EMPTY_BOARD_DATAURL = '/home/guyu/kifutalk/app/static/assets/empty_board.dataurl'
 KIFU_PERPAGE = 5
 COMMENT_PERPAGE = 6
+NODE_COMMENT_PERPAGE = 50 # comments per page of the kifu comments endpoint
+POSITION_SEARCH_PERPAGE = 20
+SEARCH_PERPAGE = 20 # results per page of the full-text search
 THUMBNAIL_SIZE = (512, 512)
+THUMBNAIL_WORKERS = 2 # 0 renders thumbnails in the request
 URL_TIMEOUT = 10 # seconds
+URL_MAX_BYTES = 2 * 1024 * 1024
+URL_WORKERS = 4
+URL_CACHE_TTL = 300 # seconds
+SGF_CACHE_SIZE = 64 * 1024 * 1024 # bytes
+SGF_PATCH_LOG_MAX = 64 * 1024 # bytes of patches before storing a new SGF
+SGF_COMPRESS_LEVEL = 6 # gzip level of stored SGF files
+# limits on SGF sent by clients (uploads, updates and patches)
+SGF_MAX_BYTES = 2 * 1024 * 1024
+SGF_MAX_NODES = 50000
+SGF_MAX_DEPTH = 1000 # nested variations
+SGF_MAX_VALUE_LENGTH = 64 * 1024 # characters of a property value
+MAX_CONTENT_LENGTH = 4 * 1024 * 1024 # bytes of a request body
+NOTIFICATION_LIMIT = 20
+NOTIFICATION_CACHE_TTL = 30 # seconds
+# create comment notifications on a background thread after responding
+DEFER_NOTIFICATIONS = False
@@ -0,0 +1,290 @@
+import argparse, datetime, os, time, zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db, sgf_store, search_index
+from app.models import User, Kifu, Position
+from app.sgf import SGF, parse_upload_sgf
+from app.storage import SGFStore
+from app.board import main_line_position, position_entries
+from app.thumbnail import render_position
+
+# import every .sgf file under the given directories and zip archives as
+# kifus of one user, e.g.
+#   python import_sgf.py --owner guyu archives/ pro_games.zip
+# games are parsed, standardized, stored and rendered in a process pool,
+# and inserted in batches with one commit each
+# source names of finished games (imported, duplicate or invalid) are
+# appended to the checkpoint file once their batch is committed and its
+# SGF files are stored, and are skipped when the import is run again
+
+# encodings tried in order for files that are not UTF-8
+ENCODINGS = ('utf-8-sig', 'gb18030', 'latin-1')
+# games handed to a worker at a time
+CHUNK_SIZE = 50
+# times a batch is inserted again after uploads took some of its ids
+MAX_INSERT_ATTEMPTS = 5
+
+def decode_sgf(data):
+  for encoding in ENCODINGS:
+    try:
+      return data.decode(encoding)
+    except UnicodeDecodeError:
+      pass
+
+# (archive path or None, file path or name in the archive) of every game
+def find_sources(paths):
+  sources = []
+  def add_file(path):
+    lower = path.lower()
+    if lower.endswith('.sgf'):
+      sources.append((None, path))
+    elif lower.endswith('.zip'):
+      try:
+        with zipfile.ZipFile(path) as archive:
+          for name in sorted(archive.namelist()):
+            if name.lower().endswith('.sgf'):
+              sources.append((path, name))
+      except (OSError, zipfile.BadZipFile) as e:
+        print(path, e)
+  for path in paths:
+    if os.path.isdir(path):
+      for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+          add_file(os.path.join(dirpath, filename))
+    else:
+      add_file(path)
+  return sources
+
+def source_name(source):
+  archive, path = source
+  return path if archive is None else '%s!%s' % (archive, path)
+
+# archives opened by this worker process
+_archives = {}
+
+def read_source(source):
+  archive, path = source
+  if archive is None:
+    with open(path, 'rb') as f:
+      return f.read()
+  if archive not in _archives:
+    _archives[archive] = zipfile.ZipFile(archive)
+  return _archives[archive].read(path)
+
+# runs in a worker process
+# parse, validate and standardize each game, replay its main line for the
+# thumbnail, and hash its positions for the index
+# returns (name, game) for each source, where game is None if it is invalid
+# the SGF itself is stored once a kifu refers to it (see store_sgf), as an
+# unreferenced blob could be collected at any time
+def load_games(sources, limits):
+  sgf = SGF(**limits)
+  games = []
+  for source in sources:
+    name = source_name(source)
+    try:
+      valid, info, root = parse_upload_sgf(decode_sgf(read_source(source)), sgf)
+    except Exception as e:
+      print(name, e)
+      valid = False
+    if not valid:
+      games.append((name, None))
+      continue
+    sgf_str = SGF().print(root)
+    sgf_hash = SGFStore.hash(sgf_str)
+    board = main_line_position(root)
+    games.append((name, {
+      'info': info,
+      'sgf': sgf_str,
+      'hash': sgf_hash,
+      'thumbnail': (board.size, bytes(board.grid)),
+      'positions': position_entries(root)
+    }))
+  return games
+
+# runs in a worker process, once the kifus with the blob are committed
+# written under the lock of the blob, as the deletion of the last other
+# kifu that shares it removes it under that lock
+def store_sgf(sgf_hash, sgf_str):
+  with sgf_store.locked(sgf_hash):
+    sgf_store.put(sgf_hash, sgf_str)
+
+def read_checkpoint(path):
+  try:
+    with open(path, 'r', encoding='utf-8') as f:
+      return set(f.read().split('\n')[:-1])
+  except FileNotFoundError:
+    return set()
+
+# values are cut to the length of their column, as some databases refuse
+# longer strings
+def fit(column, value):
+  length = Kifu.__table__.c[column].type.length
+  return value if length is None else value[:length]
+
+class Importer:
+  def __init__(self, owner, pool, checkpoint, batch_size):
+    self.owner = owner
+    self.pool = pool
+    self.checkpoint = checkpoint
+    self.batch_size = batch_size
+    self.batch = []
+    self.imported = 0
+    self.duplicates = 0
+    self.invalid = 0
+    self.failed_sgfs = 0
+    self.failed_thumbnails = 0
+
+  def add(self, name, game):
+    self.batch.append((name, game))
+    if len(self.batch) >= self.batch_size:
+      self.flush()
+
+  # insert the kifus of the batch with one commit, then store their SGF
+  # and render their thumbnails in the pool, and record the batch in the
+  # checkpoint once their SGF is stored
+  def flush(self):
+    if len(self.batch) == 0:
+      return
+    games = [game for name, game in self.batch if game is not None]
+    self.invalid += len(self.batch) - len(games)
+
+    # the same game is only imported once per owner, as with uploads
+    hashes = set(game['hash'] for game in games)
+    existing = set(r[0] for r in db.session.query(Kifu.sgf_hash).filter(
+      Kifu.owner_id == self.owner.id,
+      Kifu.sgf_hash.in_(hashes)
+    )) if hashes else set()
+    new_games = []
+    for game in games:
+      if game['hash'] in existing:
+        self.duplicates += 1
+      else:
+        existing.add(game['hash'])
+        new_games.append(game)
+
+    if new_games:
+      kifu_ids = self.__insert(new_games)
+      stored = []
+      for kifu_id, game in zip(kifu_ids, new_games):
+        stored.append(self.pool.submit(store_sgf, game['hash'], game['sgf']))
+        path = os.path.join(app.config['THUMBNAIL_FOLDER'], str(kifu_id) + '.jpg')
+        board_size, grid = game['thumbnail']
+        future = self.pool.submit(render_position, board_size, grid, app.config['THUMBNAIL_SIZE'], path)
+        future.add_done_callback(self.__rendered)
+      for future in wait(stored).done:
+        if future.exception() is not None:
+          print(future.exception())
+          self.failed_sgfs += 1
+      self.imported += len(new_games)
+
+    with open(self.checkpoint, 'a', encoding='utf-8') as f:
+      f.write(''.join(name + '\n' for name, game in self.batch))
+    self.batch = []
+
+  # ids are given explicitly so that the rows can be inserted with one
+  # statement, and are taken again if an upload took one of them meanwhile
+  # any other integrity error is raised
+  def __insert(self, games):
+    now = datetime.datetime.now()
+    for attempt in range(MAX_INSERT_ATTEMPTS):
+      first_id = (db.session.query(db.func.max(Kifu.id)).scalar() or 0) + 1
+      kifu_ids = list(range(first_id, first_id + len(games)))
+      mappings = [{
+        'id': kifu_id,
+        'title': fit('title', game['info']['PB'] + ' vs ' + game['info']['PW']
+          if game['info']['PB'] or game['info']['PW'] else 'Untitled'),
+        'description': '',
+        'black_player': fit('black_player', game['info']['PB']),
+        'white_player': fit('white_player', game['info']['PW']),
+        'black_rank': fit('black_rank', game['info']['BR']),
+        'white_rank': fit('white_rank', game['info']['WR']),
+        'komi': fit('komi', game['info']['KM']),
+        'result': fit('result', game['info']['RE']),
+        'uploaded_on': now,
+        'owner_id': self.owner.id,
+        'sgf_hash': game['hash'],
+        'comment_count': 0,
+        'star_count': 0
+      } for kifu_id, game in zip(kifu_ids, games)]
+      db.session.bulk_insert_mappings(Kifu, mappings)
+      db.session.bulk_insert_mappings(Position, [{
+        'kifu_id': kifu_id,
+        'node_id': node_id,
+        'hash': h,
+        'normalized_hash': normalized
+      } for kifu_id, game in zip(kifu_ids, games) for node_id, h, normalized in game['positions']])
+      search_index.index_kifus([(
+        m['id'], m['title'], m['black_player'], m['white_player'], m['description']
+      ) for m in mappings])
+      try:
+        db.session.commit()
+        return kifu_ids
+      except IntegrityError as e:
+        db.session.rollback()
+        taken = db.session.query(Kifu.id).filter(Kifu.id.in_(kifu_ids)).first()
+        if taken is None or attempt == MAX_INSERT_ATTEMPTS - 1:
+          raise
+        print(e)
+
+  def __rendered(self, future):
+    if future.exception() is not None:
+      print(future.exception())
+      self.failed_thumbnails += 1
+
+def main():
+  parser = argparse.ArgumentParser(description='Import SGF files as kifus')
+  parser.add_argument('paths', nargs='+', help='directories, zip archives and SGF files')
+  parser.add_argument('--owner', required=True, help='username of the owner of the kifus')
+  parser.add_argument('--workers', type=int, default=os.cpu_count())
+  parser.add_argument('--batch-size', type=int, default=500)
+  parser.add_argument('--checkpoint', default='import_sgf.checkpoint')
+  args = parser.parse_args()
+
+  with app.app_context():
+    owner = User.query.filter_by(username=args.owner).first()
+    if owner is None:
+      parser.error('no user named ' + args.owner)
+    os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+
+    done = read_checkpoint(args.checkpoint)
+    sources = [s for s in find_sources(args.paths) if source_name(s) not in done]
+    print('%d games to import, %d already done' % (len(sources), len(done)))
+
+    limits = {
+      'max_bytes': app.config['SGF_MAX_BYTES'],
+      'max_nodes': app.config['SGF_MAX_NODES'],
+      'max_depth': app.config['SGF_MAX_DEPTH'],
+      'max_value_length': app.config['SGF_MAX_VALUE_LENGTH']
+    }
+    chunks = [sources[i:i+CHUNK_SIZE] for i in range(0, len(sources), CHUNK_SIZE)]
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+      importer = Importer(owner, pool, args.checkpoint, args.batch_size)
+      # a few chunks per worker are in flight, so that workers never wait
+      # for the database and finished games do not pile up in memory
+      pending = deque()
+      next_chunk = 0
+      while pending or next_chunk < len(chunks):
+        while next_chunk < len(chunks) and len(pending) < 2 * args.workers:
+          pending.append(pool.submit(load_games, chunks[next_chunk], limits))
+          next_chunk += 1
+        for name, game in pending.popleft().result():
+          importer.add(name, game)
+      importer.flush()
+      # leaving the block waits for the remaining thumbnails
+    elapsed = time.time() - start
+
+  print('%d imported, %d duplicates, %d invalid, %d SGF files and %d thumbnails failed' % (
+    importer.imported, importer.duplicates, importer.invalid,
+    importer.failed_sgfs, importer.failed_thumbnails
+  ))
+  total = importer.imported + importer.duplicates + importer.invalid
+  print('%d games in %.1f s (%.1f games/sec)' % (total, elapsed, total / elapsed if elapsed > 0 else 0))
+
+if __name__ == '__main__':
+  main()
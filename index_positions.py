@@ -0,0 +1,27 @@
+import time
+
+from app import app, db
+from app.models import Kifu, Position, index_kifu_positions
+
+# kifus indexed per commit
+BATCH_SIZE = 100
+
+# create the positions table if needed, and index the positions of all
+# kifus that have none yet, so that an interrupted run can be started again
+with app.app_context():
+  Position.__table__.create(db.engine, checkfirst=True)
+  indexed = db.session.query(Position.kifu_id).distinct()
+  kifu_ids = [r[0] for r in db.session.query(Kifu.id)
+    .filter(Kifu.id.notin_(indexed.subquery())).order_by(Kifu.id)]
+  start = time.time()
+  for n, kifu_id in enumerate(kifu_ids, 1):
+    kifu = Kifu.query.get(kifu_id)
+    try:
+      index_kifu_positions(kifu_id, kifu.sgf_tree)
+    except Exception as e:
+      print(kifu_id, e)
+    if n % BATCH_SIZE == 0:
+      db.session.commit()
+      print('%d of %d kifus indexed' % (n, len(kifu_ids)))
+  db.session.commit()
+  print('%d kifus indexed in %.1f s' % (len(kifu_ids), time.time() - start))
@@ -0,0 +1,27 @@
+import os
+
+from app import app
+from app.models import Kifu
+from app.sgf import standardize_sgf
+
+# column added to an existing kifus table before the first run
+SQL_CMDS = [
+  'ALTER TABLE kifus ADD COLUMN sgf_hash VARCHAR(64)',
+  'CREATE INDEX ix_kifus_sgf_hash ON kifus (sgf_hash)'
+]
+
+# move the plain <id>.sgf files (and their patches) of all kifus into the
+# SGF store, where identical games share one compressed file
+with app.app_context():
+  kifu_ids = [r[0] for r in Kifu.query.filter(Kifu.sgf_hash == None).with_entities(Kifu.id)]
+  moved = 0
+  for kifu_id in kifu_ids:
+    kifu = Kifu.query.get(kifu_id)
+    try:
+      kifu.update_sgf(standardize_sgf(kifu.sgf))
+    except Exception as e:
+      print(kifu_id, e)
+      continue
+    os.remove(kifu.legacy_filepath)
+    moved += 1
+  print('%d of %d kifus moved' % (moved, len(kifu_ids)))
@@ -0,0 +1,34 @@
+import time
+
+from app import app, db, search_index
+from app.models import Kifu, Comment
+
+# rows indexed per statement
+BATCH_SIZE = 1000
+
+# drop and rebuild the full-text search index of all kifus and comments
+# also creates the index the first time
+def index_all(query, index):
+  batch = []
+  count = 0
+  for row in query.yield_per(BATCH_SIZE):
+    batch.append(tuple(row))
+    if len(batch) == BATCH_SIZE:
+      index(batch)
+      count += len(batch)
+      batch = []
+  index(batch)
+  return count + len(batch)
+
+with app.app_context():
+  start = time.time()
+  search_index.drop()
+  search_index.create()
+  kifus = index_all(db.session.query(
+    Kifu.id, Kifu.title, Kifu.black_player, Kifu.white_player, Kifu.description
+  ).order_by(Kifu.id), search_index.index_kifus)
+  comments = index_all(db.session.query(
+    Comment.id, Comment.content
+  ).order_by(Comment.id), search_index.index_comments)
+  db.session.commit()
+  print('%d kifus and %d comments indexed in %.1f s' % (kifus, comments, time.time() - start))
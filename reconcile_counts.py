@@ -0,0 +1,19 @@
+from app import app
+from app.models import reconcile_kifu_counts
+
+# columns added to an existing kifus table before the first run
+SQL_CMDS = [
+  'ALTER TABLE kifus ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0',
+  'ALTER TABLE kifus ADD COLUMN star_count INTEGER NOT NULL DEFAULT 0',
+  'CREATE INDEX ix_kifus_uploaded_on_id ON kifus (uploaded_on, id)',
+  'CREATE INDEX ix_kifus_comment_count_id ON kifus (comment_count, id)',
+  'CREATE INDEX ix_kifus_star_count_id ON kifus (star_count, id)',
+  'CREATE INDEX ix_kifus_owner_id_uploaded_on ON kifus (owner_id, uploaded_on)',
+  'CREATE INDEX ix_kifustars_kifu_id ON kifustars (kifu_id)',
+  'CREATE INDEX ix_kifustars_user_id_kifu_id ON kifustars (user_id, kifu_id)',
+  'CREATE INDEX ix_comments_kifu_id_node_id_timestamp ON comments (kifu_id, node_id, timestamp)'
+]
+
+# recompute comment_count and star_count of all kifus
+with app.app_context():
+  print('%d kifus reconciled' % reconcile_kifu_counts())
@@ -1,10 +1,11 @@
-from app import db
+from app import db, search_index
 from app.models import Rank
 
 SQL_CMD = 'CREATE DATABASE kifutalk CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci'
 
 # initialize database
 db.create_all()
+search_index.create()
 
 # populate ranks table
 for i in range(18):
@@ -0,0 +1,58 @@
+import os, shutil, tempfile
+
+import pytest
+from flask.testing import FlaskClient
+
+# settings of the app under test, read instead of instance/config.py
+# the database is an in-memory SQLite one, and work that normally runs in
+# pools (passwords, thumbnails) runs in the calling thread
+_folder = tempfile.mkdtemp()
+_config = os.path.join(_folder, 'config.py')
+with open(_config, 'w') as f:
+  f.write('\n'.join([
+    "SQLALCHEMY_DATABASE_URI = 'sqlite://'",
+    "SECRET_KEY = 'test'",
+    "TESTING = True",
+    "WTF_CSRF_ENABLED = False",
+    "BCRYPT_LOG_ROUNDS = 4",
+    "PASSWORD_WORKERS = 0",
+    "THUMBNAIL_WORKERS = 0",
+    "SGF_FOLDER = %r" % os.path.join(_folder, 'sgf'),
+    "THUMBNAIL_FOLDER = %r" % os.path.join(_folder, 'thumbnail'),
+    ''
+  ]))
+os.environ['KIFUTALK_CONFIG'] = _config
+
+from app import app as flask_app, db, search_index, sgf_cache
+
+# each request runs in an app context of its own, and so with a new g,
+# as it does when served, rather than in the app context of the test
+class AppContextClient(FlaskClient):
+  def open(self, *args, **kwargs):
+    with self.application.app_context():
+      return super().open(*args, **kwargs)
+
+flask_app.test_client_class = AppContextClient
+
+# the app with empty tables and folders, inside an app context
+@pytest.fixture
+def app():
+  for name in ('sgf', 'thumbnail'):
+    shutil.rmtree(os.path.join(_folder, name), ignore_errors=True)
+    os.makedirs(os.path.join(_folder, name))
+  with flask_app.app_context():
+    db.create_all()
+    search_index.create()
+    db.session.commit()
+    # routes are registered by importing the views, which is done once the
+    # tables exist as the forms read the ranks when imported
+    from app import views
+    yield flask_app
+    db.session.remove()
+    search_index.drop()
+    db.drop_all()
+    sgf_cache.clear()
+
+@pytest.fixture
+def client(app):
+  return app.test_client()
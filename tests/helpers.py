@@ -0,0 +1,41 @@
+import datetime, json
+
+from app import db
+from app.models import User, Rank
+
+# a user named name with the e-mail name@example.com and the password
+# password1, of the first rank (added if there is none)
+def add_user(name):
+  if Rank.query.first() is None:
+    db.session.add(Rank(rank_en='1k', rank_cn='1级'))
+  user = User(
+    email=name + '@example.com',
+    username=name,
+    password='password1',
+    rank_id=Rank.query.first().id,
+    signed_up_on=datetime.datetime.now()
+  )
+  db.session.add(user)
+  db.session.commit()
+  return user
+
+# a test client logged in as the user added with add_user(name)
+def log_in(app, name):
+  client = app.test_client()
+  r = client.post('/', data={
+    'login_email': name + '@example.com',
+    'login_password': 'password1',
+    'login_submit': 'y'
+  })
+  assert r.status_code == 302
+  return client
+
+def send_json(client, method, url, data):
+  return client.open(url, method=method, data=json.dumps(data), content_type='application/json')
+
+# id of the kifu uploaded with sgf_str
+# the same game is only uploaded once per user
+def upload(client, sgf_str, title='t'):
+  r = send_json(client, 'POST', '/upload', {'sgf': sgf_str, 'title': title, 'description': 'd'})
+  assert r.status_code == 200, r.data
+  return int(r.get_json()['redirect'].rsplit('/', 1)[1])
@@ -0,0 +1,70 @@
+import html, re
+
+from app.models import Kifu
+from helpers import add_user, log_in, send_json, upload
+
+SGF_STR = '(;GM[1]SZ[19]KM[%d];B[pd];W[dp])'
+PER_PAGE = 5
+
+# (kifu ids listed, url of the next page or None, url of the previous
+# page or None) of a browse page, with the query string added to the page
+# links as browse.js does
+def browse(client, url, query=''):
+  r = client.get(url + query)
+  assert r.status_code == 200
+  page = r.get_data(as_text=True)
+  kifu_ids = [int(k) for k in re.findall(r'href="/kifu/(\d+)"', page)]
+  links = []
+  for name in ('next', 'prev'):
+    href = html.unescape(re.search(r'id="%s"\s*href="([^"]*)"' % name, page).group(1))
+    links.append(None if href == '#' else href + query)
+  return kifu_ids, links[0], links[1]
+
+# every kifu is listed exactly once, in order, across the pages
+def walk(client, query):
+  kifu_ids = []
+  url = '/browse?page=1'
+  while url is not None:
+    page_ids, url, prev_url = browse(client, url, query)
+    assert 0 < len(page_ids) <= PER_PAGE
+    kifu_ids.extend(page_ids)
+  return kifu_ids
+
+def test_browse_pages(app, monkeypatch):
+  monkeypatch.setitem(app.config, 'KIFU_PERPAGE', PER_PAGE)
+  add_user('owner')
+  add_user('other')
+  owner = log_in(app, 'owner')
+  other = log_in(app, 'other')
+  kifu_ids = [upload(owner, SGF_STR % i) for i in range(12)]
+  for i, kifu_id in enumerate(kifu_ids):
+    for _ in range(i % 3):
+      send_json(other, 'POST', '/comment/%d/1' % kifu_id, 'c')
+  client = app.test_client()
+
+  # uploaded in the same second, ties are broken by id
+  assert walk(client, '&sort-by=date&display-in=desc') == sorted(kifu_ids, reverse=True)
+  assert walk(client, '&sort-by=date&display-in=asc') == sorted(kifu_ids)
+  by_comments = sorted(kifu_ids, key=lambda k: (Kifu.query.get(k).comment_count, k), reverse=True)
+  assert walk(client, '&sort-by=comments&display-in=desc') == by_comments
+
+# pages after the first are read from the last kifu seen, so a kifu
+# uploaded meanwhile does not shift them, and the previous page is the
+# one seen before
+def test_browse_cursor(app, monkeypatch):
+  monkeypatch.setitem(app.config, 'KIFU_PERPAGE', PER_PAGE)
+  add_user('owner')
+  owner = log_in(app, 'owner')
+  kifu_ids = [upload(owner, SGF_STR % i) for i in range(12)]
+  newest = sorted(kifu_ids, reverse=True)
+  client = app.test_client()
+  query = '&sort-by=date&display-in=desc'
+
+  first, next_url, prev_url = browse(client, '/browse?page=1', query)
+  assert first == newest[:5] and prev_url is None
+  upload(owner, SGF_STR % 12)
+  second, next_url, prev_url = browse(client, next_url, query)
+  assert second == newest[5:10]
+  third, next_url, prev_url = browse(client, next_url, query)
+  assert third == newest[10:] and next_url is None
+  assert browse(client, prev_url, query)[0] == second
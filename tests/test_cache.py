@@ -0,0 +1,66 @@
+import json
+
+from app.cache import SGFCache
+from app.sgf import SGF
+from app.sgf import copy_tree, parse_patch_op, apply_patch
+
+SGF_STR = '(;GM[1]SZ[19]ID[0];B[pd]ID[1];W[dp]ID[2])'
+COST = SGFCache.TREE_COST_FACTOR + 1
+
+def write(path, data):
+  with open(path, 'w') as f:
+    f.write(data)
+
+# patch the cached tree of kifu_id as Kifu.patch_sgf does
+def patch(cache, kifu_id, path, log_path, node_id):
+  root, index = cache.get_index(kifu_id, path, log_path)
+  new_root, new_index = copy_tree(root)
+  op = {'parent': 2, 'sgf': '(;B[dd]ID[%d])' % node_id}
+  with open(log_path, 'a') as f:
+    f.write(json.dumps(op) + '\n')
+  added = {}
+  apply_patch(new_index, added, [parse_patch_op(new_index, added, op['parent'], op['sgf'])])
+  cache.patched(kifu_id, root, new_root, new_index, path, log_path)
+
+def test_patched_cost(tmp_path):
+  path = str(tmp_path / '1.sgf')
+  log_path = path + '.log'
+  write(path, SGF_STR)
+  cache = SGFCache(1024 * 1024)
+  cache.get_index(1, path, log_path)
+  assert cache.size == len(SGF_STR) * COST
+  patch(cache, 1, path, log_path, 3)
+  patch(cache, 1, path, log_path, 4)
+  assert cache.size == (len(SGF_STR) + len(open(log_path).read())) * COST
+  # the patched tree is still served from the cache
+  misses = cache.misses
+  root, index = cache.get_index(1, path, log_path)
+  assert cache.misses == misses and 4 in index
+
+# a reader keeps the tree it got, which patches do not change
+def test_patch_leaves_tree_of_readers(tmp_path):
+  path = str(tmp_path / '1.sgf')
+  log_path = path + '.log'
+  write(path, SGF_STR)
+  cache = SGFCache(1024 * 1024)
+  root, index = cache.get_index(1, path, log_path)
+  patch(cache, 1, path, log_path, 3)
+  assert 3 not in index and index[2].children == []
+  new_root, new_index = cache.get_index(1, path, log_path)
+  assert new_root is not root
+  assert new_index[3].parent is new_index[2]
+  assert SGF().print(new_root) == SGF().print(SGF().parse(SGF_STR[:-1] + ';B[dd]ID[3])'))
+
+def test_patched_evicts(tmp_path):
+  paths = [str(tmp_path / ('%d.sgf' % i)) for i in (1, 2)]
+  for path in paths:
+    write(path, SGF_STR)
+  # room for both trees, until the first one grows
+  cache = SGFCache(2 * len(SGF_STR) * COST + 10)
+  cache.get_index(2, paths[1])
+  cache.get_index(1, paths[0], paths[0] + '.log')
+  patch(cache, 1, paths[0], paths[0] + '.log', 3)
+  assert cache.size <= cache.max_bytes
+  misses = cache.misses
+  cache.get_index(2, paths[1])
+  assert cache.misses == misses + 1
@@ -0,0 +1,60 @@
+import os
+
+from app import search_index, sgf_store
+from app.models import Kifu, Comment, KifuStar, Notification, Position
+from helpers import add_user, log_in, send_json, upload
+
+SGF_STR = '(;GM[1]SZ[19]KM[%s];B[pd];W[dp];B[pp])'
+
+def rows(model, kifu_id):
+  return model.query.filter_by(kifu_id=kifu_id).count()
+
+def notifications(kifu_id):
+  return Notification.query.join(Comment, Notification.comment_id == Comment.id) \
+    .filter(Comment.kifu_id == kifu_id).count()
+
+# everything about a deleted kifu is gone, and nothing about the others
+def test_kifu_delete(app):
+  add_user('owner')
+  add_user('other')
+  owner = log_in(app, 'owner')
+  other = log_in(app, 'other')
+  gone = upload(owner, SGF_STR % '6.5', 'gone kifu')
+  kept = upload(owner, SGF_STR % '7.5', 'kept kifu')
+  # the same game as the deleted kifu, sharing its stored SGF
+  shared = upload(other, SGF_STR % '6.5', 'shared kifu')
+  for kifu_id in (gone, kept):
+    send_json(other, 'POST', '/comment/%d/2' % kifu_id, 'first')
+    send_json(owner, 'POST', '/comment/%d/2' % kifu_id, 'second')
+    send_json(other, 'POST', '/star/kifu/%d' % kifu_id, None)
+  kifu = Kifu.query.get(gone)
+  sgf_hash, paths = kifu.sgf_hash, [kifu.imagepath]
+  for model in (Comment, KifuStar, Position):
+    assert rows(model, gone) > 0
+  assert notifications(gone) > 0
+  assert search_index.search('gone') == [(0, gone)]
+  assert all(os.path.exists(path) for path in paths)
+
+  r = send_json(owner, 'DELETE', '/kifu/%d' % gone, None)
+  assert r.status_code == 200, r.data
+
+  assert Kifu.query.get(gone) is None
+  for model in (Comment, KifuStar, Position):
+    assert rows(model, gone) == 0
+    assert rows(model, kept) > 0
+  assert notifications(gone) == 0 and notifications(kept) > 0
+  assert search_index.search('gone') == []
+  assert len(search_index.search('first')) == 1
+  assert search_index.search('kept') == [(0, kept)]
+  assert not any(os.path.exists(path) for path in paths)
+  # the stored SGF is still used by the other user's kifu
+  assert os.path.exists(sgf_store.path(sgf_hash))
+  assert Kifu.query.get(shared).sgf_hash == sgf_hash and 'KM[6.5]' in Kifu.query.get(shared).sgf
+
+def test_kifu_delete_by_other_user(app):
+  add_user('owner')
+  add_user('other')
+  kifu_id = upload(log_in(app, 'owner'), SGF_STR % '6.5')
+  r = send_json(log_in(app, 'other'), 'DELETE', '/kifu/%d' % kifu_id, None)
+  assert r.status_code == 401
+  assert Kifu.query.get(kifu_id) is not None
@@ -0,0 +1,57 @@
+import io, zipfile
+
+from app.models import Kifu, User
+from helpers import add_user, log_in, send_json, upload
+
+SGF_STR = '(;GM[1]SZ[19]KM[%d];B[pd];W[dp];B[pp])'
+
+# names and contents of the files in the archive of url
+def export(client, url):
+  r = client.get(url)
+  assert r.status_code == 200
+  assert r.mimetype == 'application/zip'
+  archive = zipfile.ZipFile(io.BytesIO(r.data))
+  assert archive.testzip() is None
+  return {name: archive.read(name).decode('utf-8') for name in archive.namelist()}
+
+def test_export_uploads(app):
+  add_user('owner')
+  add_user('other')
+  owner = log_in(app, 'owner')
+  other = log_in(app, 'other')
+  kifu_ids = [upload(owner, SGF_STR % i) for i in range(3)]
+  # the same game stored once for both users
+  other_id = upload(other, SGF_STR % 0)
+  # patched kifus are exported with their patches
+  r = send_json(owner, 'PATCH', '/kifu/%d' % kifu_ids[1], {
+    'ops': [{'parent': 4, 'sgf': '(;W[dd]ID[5])'}]
+  })
+  assert r.status_code == 200, r.data
+  owner_id = User.query.filter_by(username='owner').first().id
+
+  files = export(app.test_client(), '/export/user-upload/%d' % owner_id)
+  assert sorted(files) == sorted('%d.sgf' % k for k in kifu_ids)
+  for kifu_id in kifu_ids:
+    assert files['%d.sgf' % kifu_id] == Kifu.query.get(kifu_id).sgf
+  assert 'W[dd]ID[5]' in files['%d.sgf' % kifu_ids[1]]
+  assert 'KM[0]' in files['%d.sgf' % kifu_ids[0]]
+  assert '%d.sgf' % other_id not in files
+
+def test_export_saved(app):
+  add_user('owner')
+  add_user('other')
+  owner = log_in(app, 'owner')
+  other = log_in(app, 'other')
+  kifu_ids = [upload(owner, SGF_STR % i) for i in range(3)]
+  send_json(other, 'POST', '/star/kifu/%d' % kifu_ids[2], None)
+  send_json(other, 'POST', '/star/kifu/%d' % kifu_ids[0], None)
+  other_id = User.query.filter_by(username='other').first().id
+
+  files = export(app.test_client(), '/export/user-save/%d' % other_id)
+  assert sorted(files) == ['%d.sgf' % kifu_ids[0], '%d.sgf' % kifu_ids[2]]
+  assert files['%d.sgf' % kifu_ids[2]] == Kifu.query.get(kifu_ids[2]).sgf
+
+def test_export_empty(app):
+  user = add_user('owner')
+  assert export(app.test_client(), '/export/user-upload/%d' % user.id) == {}
+  assert app.test_client().get('/export/user-upload/%d' % (user.id + 1)).status_code == 404
@@ -0,0 +1,141 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app import fetch as fetch_module
+from app.fetch import SGFFetcher, NetworkError, TooLargeError, NotSGFError, BusyError
+
+SGF_BYTES = b'(;GM[1]SZ[19];B[pd];W[dp])'
+ETAG = '"v1"'
+MAX_BYTES = 1000
+
+class Handler(BaseHTTPRequestHandler):
+  def log_message(self, *args):
+    pass
+
+  def send_body(self, body, content_type='application/x-go-sgf', length=True, headers={}):
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    if length:
+      self.send_header('Content-Length', str(len(body)))
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+    try:
+      self.wfile.write(body)
+    except (BrokenPipeError, ConnectionResetError):
+      # the fetcher stops reading responses it rejects
+      pass
+
+  def do_GET(self):
+    server = self.server
+    server.requests.append((self.path, self.headers.get('If-None-Match')))
+    if self.path == '/game.sgf':
+      if self.headers.get('If-None-Match') == ETAG:
+        self.send_response(304)
+        self.end_headers()
+      else:
+        self.send_body(SGF_BYTES, headers={'ETag': ETAG})
+    elif self.path == '/long.sgf':
+      self.send_body(b'(;C[' + b'x' * 100000 + b'])')
+    elif self.path == '/streamed.sgf':
+      # no Content-Length, so the cap is only seen while reading
+      self.send_body(b'(;C[' + b'x' * 100000 + b'])', length=False)
+    elif self.path == '/page.html':
+      self.send_body(b'<html><body>(;B[pd])</body></html>', 'text/html')
+    elif self.path == '/empty.sgf':
+      self.send_body(b'  \n')
+    elif self.path.startswith('/slow/'):
+      server.slow_started.set()
+      server.release.wait(10)
+      self.send_body(SGF_BYTES)
+    else:
+      self.send_error(404)
+
+@pytest.fixture
+def server():
+  server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  server.daemon_threads = True
+  server.requests = []
+  server.slow_started = threading.Event()
+  server.release = threading.Event()
+  thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+  thread.start()
+  yield server
+  server.release.set()
+  server.shutdown()
+  server.server_close()
+
+# stands in for the time module of the fetcher, whose clock only moves
+# when the test says so
+class Clock:
+  def __init__(self):
+    self.now = 1000.0
+
+  def monotonic(self):
+    return self.now
+
+def url(server, path):
+  return 'http://127.0.0.1:%d%s' % (server.server_address[1], path)
+
+def test_fetch(server):
+  fetcher = SGFFetcher(2, MAX_BYTES, 5, 60)
+  assert fetcher.fetch(url(server, '/game.sgf')) == SGF_BYTES.decode()
+
+def test_byte_cap(server):
+  fetcher = SGFFetcher(2, MAX_BYTES, 5, 60)
+  with pytest.raises(TooLargeError):
+    fetcher.fetch(url(server, '/long.sgf'))
+  with pytest.raises(TooLargeError):
+    fetcher.fetch(url(server, '/streamed.sgf'))
+
+def test_not_sgf(server):
+  fetcher = SGFFetcher(2, MAX_BYTES, 5, 60)
+  with pytest.raises(NotSGFError):
+    fetcher.fetch(url(server, '/page.html'))
+  with pytest.raises(NotSGFError):
+    fetcher.fetch(url(server, '/empty.sgf'))
+  with pytest.raises(NetworkError):
+    fetcher.fetch(url(server, '/missing.sgf'))
+  with pytest.raises(NetworkError):
+    fetcher.fetch('file:///etc/passwd')
+
+def test_cache_and_etag(server, monkeypatch):
+  clock = Clock()
+  monkeypatch.setattr(fetch_module, 'time', clock)
+  fetcher = SGFFetcher(2, MAX_BYTES, 5, 60)
+  game = url(server, '/game.sgf')
+  assert fetcher.fetch(game) == SGF_BYTES.decode()
+  # fresh, served from the cache
+  clock.now += 30
+  assert fetcher.fetch(game) == SGF_BYTES.decode()
+  assert server.requests == [('/game.sgf', None)]
+  # expired, revalidated with the ETag and answered with 304
+  clock.now += 60
+  assert fetcher.fetch(game) == SGF_BYTES.decode()
+  assert server.requests == [('/game.sgf', None), ('/game.sgf', ETAG)]
+  # fresh again after the revalidation
+  assert fetcher.fetch(game) == SGF_BYTES.decode()
+  assert len(server.requests) == 2
+
+def test_busy(server):
+  # one worker, so at most two fetches are running or waiting
+  fetcher = SGFFetcher(1, MAX_BYTES, 5, 60)
+  results = []
+  def fetch(path):
+    results.append(fetcher.fetch(url(server, path)))
+  running = threading.Thread(target=fetch, args=('/slow/1',))
+  running.start()
+  assert server.slow_started.wait(5)
+  waiting = threading.Thread(target=fetch, args=('/slow/2',))
+  waiting.start()
+  waiting.join(0.2)
+  with pytest.raises(BusyError):
+    fetcher.fetch(url(server, '/slow/3'))
+  server.release.set()
+  running.join(5)
+  waiting.join(5)
+  assert results == [SGF_BYTES.decode()] * 2
+  # fetches are accepted again once the others are done
+  assert fetcher.fetch(url(server, '/slow/3')) == SGF_BYTES.decode()
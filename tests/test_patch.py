@@ -0,0 +1,71 @@
+import gzip, os
+
+from app.models import Kifu
+from helpers import add_user, log_in, send_json, upload
+
+# nodes get the ids 0 to 4, patches add a node with a new id under 4
+SGF_STR = '(;GM[1]SZ[19];B[pd];W[dp];B[pp])'
+
+def patch(client, kifu_id, node_id):
+  r = send_json(client, 'PATCH', '/kifu/%d' % kifu_id, {
+    'ops': [{'parent': 4, 'sgf': '(;W[dd]ID[%d])' % node_id}]
+  })
+  assert r.status_code == 200, r.data
+
+def log_size(kifu):
+  return os.path.getsize(kifu.logpath)
+
+# downloads serve the patched tree and leave the stored SGF as it is
+def test_download_patched(app):
+  add_user('owner')
+  client = log_in(app, 'owner')
+  kifu_id = upload(client, SGF_STR)
+  patch(client, kifu_id, 5)
+  kifu = Kifu.query.get(kifu_id)
+  old_hash = kifu.sgf_hash
+  size = log_size(kifu)
+  assert size > 0
+
+  viewer = app.test_client()
+  r = viewer.get('/download/%d' % kifu_id)
+  assert r.status_code == 200 and b'W[dd]ID[5]' in r.data
+  r = viewer.get('/download/%d' % kifu_id, headers={'Accept-Encoding': 'gzip'})
+  assert r.status_code == 200 and b'W[dd]ID[5]' in gzip.decompress(r.data)
+  kifu = Kifu.query.get(kifu_id)
+  assert kifu.sgf_hash == old_hash and log_size(kifu) == size
+
+def test_compact_sgf(app):
+  add_user('owner')
+  client = log_in(app, 'owner')
+  kifu_id = upload(client, SGF_STR)
+  patch(client, kifu_id, 5)
+  kifu = Kifu.query.get(kifu_id)
+  old_hash = kifu.sgf_hash
+  kifu.compact_sgf()
+  kifu = Kifu.query.get(kifu_id)
+  assert log_size(kifu) == 0
+  assert kifu.sgf_hash != old_hash
+  assert 'W[dd]ID[5]' in kifu.sgf
+  assert b'W[dd]ID[5]' in gzip.decompress(kifu.sgf_gzip)
+
+def test_download_without_patches_keeps_sgf(app):
+  add_user('owner')
+  client = log_in(app, 'owner')
+  kifu_id = upload(client, SGF_STR)
+  old_hash = Kifu.query.get(kifu_id).sgf_hash
+  assert client.get('/download/%d' % kifu_id).status_code == 200
+  assert Kifu.query.get(kifu_id).sgf_hash == old_hash
+
+def test_log_compacted_past_max(app, monkeypatch):
+  monkeypatch.setitem(app.config, 'SGF_PATCH_LOG_MAX', 100)
+  add_user('owner')
+  client = log_in(app, 'owner')
+  kifu_id = upload(client, SGF_STR)
+  patch(client, kifu_id, 5)
+  kifu = Kifu.query.get(kifu_id)
+  assert 0 < log_size(kifu) <= 100
+  patch(client, kifu_id, 6)
+  patch(client, kifu_id, 7)
+  kifu = Kifu.query.get(kifu_id)
+  assert log_size(kifu) == 0
+  assert kifu.sgf.count('W[dd]') == 3
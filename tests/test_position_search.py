@@ -0,0 +1,49 @@
+from helpers import add_user, log_in, upload
+
+# node 2 of each kifu is the position after its second move
+SGF_STR = '(;GM[1]SZ[19];B[pd];W[dp];B[pp])'
+# mirrored left to right
+MIRRORED = '(;GM[1]SZ[19];B[dd];W[pp];B[dp])'
+# rotated a half turn
+ROTATED = '(;GM[1]SZ[19];B[dp];W[pd];B[dd])'
+OTHER = '(;GM[1]SZ[19];B[qd];W[dp];B[pp])'
+
+def search(client, query):
+  r = client.get('/search/position?' + query)
+  assert r.status_code == 200, r.data
+  return r.get_json()
+
+def found(result):
+  return [(k['id'], k['node_id']) for k in result['kifus']]
+
+def test_search_mirrored_position(app):
+  add_user('owner')
+  client = log_in(app, 'owner')
+  kifu_id = upload(client, SGF_STR)
+  mirrored_id = upload(client, MIRRORED)
+  rotated_id = upload(client, ROTATED)
+  upload(client, OTHER)
+  viewer = app.test_client()
+
+  result = search(viewer, 'kifu_id=%d&node_id=2' % kifu_id)
+  assert result['symmetric']
+  assert found(result) == [(mirrored_id, 2), (rotated_id, 2)]
+  assert found(search(viewer, 'hash=%s' % result['hash'])) == [
+    (kifu_id, 2), (mirrored_id, 2), (rotated_id, 2)
+  ]
+  # the same position from the mirrored kifu
+  assert found(search(viewer, 'kifu_id=%d&node_id=2' % mirrored_id)) == [
+    (kifu_id, 2), (rotated_id, 2)
+  ]
+  # only the exact position
+  assert found(search(viewer, 'kifu_id=%d&node_id=2&symmetric=0' % kifu_id)) == []
+
+def test_search_position_errors(app):
+  add_user('owner')
+  client = log_in(app, 'owner')
+  kifu_id = upload(client, SGF_STR)
+  viewer = app.test_client()
+  assert viewer.get('/search/position').status_code == 400
+  assert viewer.get('/search/position?hash=x').status_code == 400
+  assert viewer.get('/search/position?kifu_id=%d&node_id=9' % kifu_id).status_code == 404
+  assert viewer.get('/search/position?kifu_id=%d&node_id=2' % (kifu_id + 1)).status_code == 404
@@ -0,0 +1,56 @@
+import pytest
+from sqlalchemy import event
+
+from app import db
+from app.models import Kifu
+from helpers import add_user, log_in, send_json, upload
+
+SGF_STR = '(;GM[1]SZ[19]PB[Black]PW[White]KM[%s];B[pd];W[dp];B[pp])'
+
+# number of statements run by a GET of url and its JSON, if any
+# the url is requested once before, so that the counted request does not
+# load what is shared by all requests (e.g. the templates)
+def count_queries(client, url):
+  assert client.get(url).status_code == 200
+  statements = []
+  def before_execute(conn, cursor, statement, *args):
+    statements.append(statement)
+  event.listen(db.engine, 'before_cursor_execute', before_execute)
+  try:
+    r = client.get(url)
+  finally:
+    event.remove(db.engine, 'before_cursor_execute', before_execute)
+  assert r.status_code == 200
+  return len(statements), r.get_json(silent=True)
+
+# a kifu with one comment and one with comments by many users on several
+# nodes take the same number of queries
+@pytest.fixture
+def kifus(app):
+  names = ['owner'] + ['user%d' % i for i in range(5)]
+  for name in names:
+    add_user(name)
+  clients = {name: log_in(app, name) for name in names}
+  # different games, as the same game is only uploaded once
+  one = upload(clients['owner'], SGF_STR % '6.5')
+  many = upload(clients['owner'], SGF_STR % '7.5')
+  send_json(clients['user0'], 'POST', '/comment/%d/1' % one, 'only')
+  for i in range(12):
+    send_json(clients['user%d' % (i % 5)], 'POST', '/comment/%d/%d' % (many, i % 3 + 1), 'comment %d' % i)
+  assert Kifu.query.get(many).comment_count == 12
+  return one, many
+
+def test_kifu_get_queries(app, kifus):
+  one, many = kifus
+  client = app.test_client()
+  assert count_queries(client, '/kifu/%d' % one)[0] == count_queries(client, '/kifu/%d' % many)[0]
+
+def test_kifu_comments_queries(app, kifus):
+  one, many = kifus
+  client = app.test_client()
+  count_one, data_one = count_queries(client, '/kifu/%d/comments' % one)
+  count_many, data_many = count_queries(client, '/kifu/%d/comments' % many)
+  # the same page is read, with the authors of all its comments
+  assert len(data_one['comments']) == 1 and len(data_many['comments']) == 12
+  assert len(set(c['author_username'] for c in data_many['comments'])) == 5
+  assert count_one == count_many
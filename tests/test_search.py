@@ -0,0 +1,31 @@
+from app import db, search_index
+from app.search import tokenize
+
+def test_tokenize():
+  assert tokenize('柯洁 vs Shin') == ['柯洁', 'vs', 'shin']
+  assert tokenize('围棋定式') == ['围棋', '棋定', '定式']
+  assert tokenize('围棋定式', unigrams=True) == ['围棋', '棋定', '定式', '围', '棋', '定', '式']
+  assert tokenize('洁', unigrams=True) == ['洁']
+
+def search(query, kind=None):
+  return sorted(search_index.search(query, kind))
+
+def test_search(app):
+  search_index.index_kifus([
+    (1, '柯洁 vs 申真谞', '柯洁', '申真谞', 'LG cup final'),
+    (2, 'Shin Jinseo vs Ke Jie', 'Shin Jinseo', 'Ke Jie', '')
+  ])
+  search_index.index_comments([(1, '这步棋很妙'), (2, 'nice tesuji')])
+  db.session.commit()
+
+  assert search('柯洁') == [(0, 1)]
+  # a single character is found at any place of a run
+  assert search('柯') == [(0, 1)]
+  assert search('洁') == [(0, 1)]
+  assert search('真') == [(0, 1)]
+  assert search('妙') == [(1, 1)]
+  assert search('Shin') == [(0, 2)]
+  assert search('shin jie') == [(0, 2)]
+  assert search('cup', 'comment') == []
+  assert search('tesuji', 'comment') == [(1, 2)]
+  assert search('围棋') == []
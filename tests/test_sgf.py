@@ -0,0 +1,76 @@
+import pytest
+
+from app.sgf import SGF, Node, SGFTooDeepError, SGFTooManyNodesError, SGFValueTooLongError, copy_tree, index_tree, validate_sgf
+
+def parse(sgf_str, **limits):
+  return SGF(**limits).parse(sgf_str)
+
+def comments(root):
+  values = []
+  stack = [root]
+  while stack:
+    node = stack.pop()
+    values.extend(value for prop, value in node.action_pairs() if prop == 'C')
+    stack.extend(reversed(node.children))
+  return values
+
+def test_escaped_bracket_stays_in_value():
+  root = parse('(;C[a\\]b];B[aa])')
+  assert comments(root) == ['a\\]b']
+  assert root.children[0].children[0].props == ['B']
+
+def test_escaped_backslash_before_closing_bracket():
+  root = parse('(;C[a\\\\];B[aa];W[bb])')
+  assert comments(root) == ['a\\\\']
+  # the following nodes are not swallowed into the comment
+  node = root.children[0].children[0]
+  assert list(node.action_pairs()) == [('B', 'aa')]
+  assert list(node.children[0].action_pairs()) == [('W', 'bb')]
+
+def test_escapes_round_trip():
+  sgf_str = '(;C[x\\\\\\]y\\\\];B[aa])'
+  root = parse(sgf_str)
+  assert comments(root) == ['x\\\\\\]y\\\\']
+  assert comments(parse(SGF().print(root))) == comments(root)
+
+def test_escaped_bracket_does_not_close_value():
+  # as with other unclosed values, the [ is skipped and nothing is read
+  assert comments(parse('(;C[abc\\])')) == []
+
+def test_limits():
+  with pytest.raises(SGFTooManyNodesError):
+    parse('(;B[aa];W[bb];B[cc])', max_nodes=2)
+  with pytest.raises(SGFTooDeepError):
+    parse('((;B[aa]))', max_depth=1)
+  with pytest.raises(SGFValueTooLongError):
+    parse('(;C[abcdef])', max_value_length=5)
+  # an escaped backslash at the end of the longest value allowed
+  assert comments(parse('(;C[abc\\\\])', max_value_length=5)) == ['abc\\\\']
+
+def test_copy_tree():
+  root = SGF().parse('(;GM[1]ID[0](;B[pd]ID[1];W[dp]ID[2])(;B[dd]ID[3]))')
+  copy, index = copy_tree(root)
+  assert SGF().print(copy) == SGF().print(root)
+  assert index == index_tree(copy)
+  original = index_tree(root)
+  for node_id, node in index.items():
+    assert node is not original[node_id]
+    for child in node.children:
+      assert child.parent is node
+  # the original tree is left as it is
+  index[2].children.append(Node(index[2]))
+  assert original[2].children == []
+
+# the legacy parser (like sgf.js) reads escapes as the tokenizer does
+def test_legacy_escapes():
+  for sgf_str in (
+    r'(;GM[1];C[a\\];B[pd])',
+    r'(;GM[1];C[x\]y];B[pd])',
+    r'(;GM[1];C[a\\\]b\\\\];B[pd](;W[dd])(;W[dp]))'
+  ):
+    assert SGF(legacy=True).print(SGF(legacy=True).parse(sgf_str)) == SGF().print(SGF().parse(sgf_str))
+
+def test_validate_sgf():
+  assert validate_sgf('(;GM[1];B[pd])')
+  assert not validate_sgf('(;B[pd]')
+  assert not validate_sgf(None)
@@ -0,0 +1,29 @@
+import os
+
+from app.sgf import SGF
+from app.thumbnail import ThumbnailPipeline
+
+SGF_STR = '(;GM[1]SZ[19];B[pd];W[dd];B[pq])'
+
+# as kifu_delete does: cancel, then remove whatever was already written
+def delete(pipeline, path):
+  pipeline.cancel(path)
+  if os.path.exists(path):
+    os.remove(path)
+
+def test_cancelled_render_leaves_no_file(tmp_path):
+  pipeline = ThumbnailPipeline(1, (60, 60))
+  path = str(tmp_path / '1.jpg')
+  pipeline.submit(path, SGF().parse(SGF_STR))
+  delete(pipeline, path)
+  pipeline.join()
+  assert not os.path.exists(path)
+
+def test_render_after_cancel_is_written(tmp_path):
+  pipeline = ThumbnailPipeline(1, (60, 60))
+  path = str(tmp_path / '1.jpg')
+  pipeline.submit(path, SGF().parse(SGF_STR))
+  delete(pipeline, path)
+  pipeline.submit(path, SGF().parse(SGF_STR))
+  pipeline.join()
+  assert os.path.exists(path)
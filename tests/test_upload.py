@@ -0,0 +1,33 @@
+from app.models import Kifu
+from helpers import add_user, log_in, send_json, upload
+
+SGF_STR = '(;GM[1]SZ[19]PB[Black]PW[White];B[pd];W[dp])'
+
+def test_duplicate_upload_refused(app):
+  add_user('owner')
+  client = log_in(app, 'owner')
+  kifu_id = upload(client, SGF_STR)
+  r = send_json(client, 'POST', '/upload', {'sgf': SGF_STR, 'title': 'again', 'description': 'new'})
+  assert r.status_code == 409
+  data = r.get_json()
+  assert data['duplicate'] and data['message']
+  assert data['redirect'].endswith('/kifu/%d' % kifu_id)
+  assert Kifu.query.count() == 1
+  assert Kifu.query.get(kifu_id).title == 't'
+
+# other users upload the same game as a kifu of their own
+def test_same_game_other_user(app):
+  add_user('owner')
+  add_user('other')
+  kifu_id = upload(log_in(app, 'owner'), SGF_STR)
+  other_id = upload(log_in(app, 'other'), SGF_STR)
+  assert other_id != kifu_id
+  assert Kifu.query.get(other_id).sgf_hash == Kifu.query.get(kifu_id).sgf_hash
+
+def test_invalid_upload(app):
+  add_user('owner')
+  client = log_in(app, 'owner')
+  for sgf in ('(;B[pd]', 'not sgf', 123, None):
+    r = send_json(client, 'POST', '/upload', {'sgf': sgf, 'title': 't', 'description': 'd'})
+    assert r.status_code == 400, sgf
+  assert Kifu.query.count() == 0